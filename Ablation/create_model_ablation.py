@@ -7,6 +7,9 @@ import torch.nn.functional as F
 from torchvision import models
 
 import torch
+
+from datasets.data_utils import ClassSampler
+
 transform = transforms.Compose([transforms.Resize((64, 64)),
                                 transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5),
                                                                             (0.5, 0.5, 0.5))])
@@ -94,11 +97,13 @@ if __name__ == '__main__':
     #                                     shuffle=False)
 
     dataset_first = datasets.KMNIST(root='.', train=True, download=True,transform=transformMnist)
-    trainloader = torch.utils.data.DataLoader(dataset_first, batch_size=batch_size, shuffle=True)
+    # Only the lower classes 0 to 5 are sampled
+    trainloader = torch.utils.data.DataLoader(dataset_first, batch_size=batch_size,
+                                              sampler=ClassSampler(dataset_first.targets, upper=False, shuffle=True))
 
     dataset_test = datasets.KMNIST(root='.', train=False, download=True,transform=transformMnist)
     testloader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size,
-                                             shuffle=False)
+                                             sampler=ClassSampler(dataset_test.targets, upper=False))
 
 
     #network = Simple_Net().cuda()
@@ -124,11 +129,6 @@ if __name__ == '__main__':
             # get the inputs; data is a list of [inputs, labels]
             optimizer.zero_grad()
             inputs, labels = data
-            ind_to_train = np.where(labels < 5 )
-            if len(ind_to_train[0]) == 0:
-                continue
-            labels = labels[ind_to_train[0]]
-            inputs = inputs[ind_to_train[0]]
             #plt.imshow(inputs.detach().cpu().numpy()[0].transpose())
             outputs = network(inputs.cuda())
             loss = criterion(outputs, labels.cuda())
@@ -147,11 +147,6 @@ if __name__ == '__main__':
             for data in testloader:
                 count += 1
                 images, labels = data
-                ind_to_train = np.where(labels < 5)
-                if len(ind_to_train[0]) == 0:
-                    continue
-                labels = labels[ind_to_train[0]]
-                images = images[ind_to_train[0]]
 
                 outputs = network(images.cuda())
                 _, predicted = torch.max(outputs.data, 1)
@@ -8,6 +8,7 @@ from torch.utils.tensorboard import SummaryWriter
 import torch.optim as optim
 from Pretrained_creation import  Simple_Net, Large_Simple_Net
 from CustomStatisticGrad import CustomStatisticGrad
+from CustomStatisticGrad.buffers import GrowableBuffer
 import argparse
 from datasets.data_utils import cifar_part, kmnist_part, mnist_part, Fmnist_part
 import os
@@ -59,7 +60,8 @@ for k,v in weight_dict_change.items():
 #fig, axs = plt.subplots(1, num)
     #fig.suptitle(f'layer: {k}')
     plt.figure()
-    cat_weights = []
+    # Columns of the compared kernels image, stored as rows so they are appended along the first dimension
+    cat_weights = GrowableBuffer(num * (3 * h + 2) + (num - 1) * 3)
     for i in range(num):
         catted_weight = (torch.cat([weights_alg[i], torch.ones((depth*w,1)) * torch.nan,weights_original[i], torch.ones((depth*w,1)) * torch.nan, weights_alg_more_samples[i] ],dim=1)  )
         error_weight += torch.sum(torch.abs(weights_alg[i] -weights_original[i]) )
@@ -69,10 +71,9 @@ for k,v in weight_dict_change.items():
         size_2_average +=  len(torch.flatten(weights_original[i]) )
 
         if len(cat_weights) >0:
-            cat_weights = torch.cat([ cat_weights, torch.ones((depth*w,3)) * torch.nan, catted_weight], dim=1)
-        else:
-            cat_weights = catted_weight
-        plt.imshow(cat_weights.numpy().transpose())
+            cat_weights.append(torch.ones((3, depth*w)) * torch.nan)
+        cat_weights.append(catted_weight.t())
+        plt.imshow(cat_weights.view().numpy())
         #avg_error = np.round((error_weight/size_2_average).numpy(),7)
         #avg_error_larger  = np.round((error_weight_more_samples/size_2_average).numpy(),7)
         #plt.title((f'layer: {k}' f'  Avg error 8 samples' + str(avg_error) + f'  Avg error larger samples' + str(avg_error_larger)))
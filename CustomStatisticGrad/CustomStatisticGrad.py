@@ -1,20 +1,38 @@
 import numpy as np
 from collections import defaultdict
+from functools import partial
 from scipy import stats
 import matplotlib.pyplot as plt
 import matplotlib
 matplotlib.use('TkAgg')
+import contextlib
 import os
 import torch
 import scipy
 import torchvision
-from CustomStatisticGrad.Encdoer_decoder import DeepAutoencoder
+from CustomStatisticGrad.Encdoer_decoder import DeepAutoencoder, FoldedEncoder
 from  CustomStatisticGrad.PreProcess import PriorPreprocess
+from CustomStatisticGrad.accumulators import ChannelStatistics, ChannelReservoir
+from CustomStatisticGrad.buffers import GrowableBuffer
+from CustomStatisticGrad.activation_store import ActivationStore, LazyChannels
+from CustomStatisticGrad.inference import AnalysisEngine
+from CustomStatisticGrad.parallel import parallel_collect, loader_batch_size, is_sequential
+from datasets.prefetch import BackgroundLoader
+from CustomStatisticGrad.distributed import distributed_collect, broadcast_grad_masks, is_main_rank
+from CustomStatisticGrad.grad_masks import GradientMasks, hard_freeze
+from CustomStatisticGrad.sketches import ChannelQuantileSketch
+from CustomStatisticGrad.statistic_metrics import batched_histogramdd_kl
+from CustomStatisticGrad.similarity import sketch_similarity, layer_similarity, log_abs_filter
 import torch
 import torch.nn.functional as F
 
 from scipy.stats import entropy
 
+# Names of the analysed data streams: pretrained dataset, new dataset and second pretrained dataset.
+STREAMS = ('pre', 'test', 'pre2')
+# Storage dtype of the collected activations per precision policy, None keeps the dtype of the forward.
+PRECISIONS = {'float32': None, 'bfloat16': torch.bfloat16, 'float16': torch.float16}
+
 def kl(p, q):
     # Kl divergence metric
     p = np.abs(np.asarray(p, dtype=np.float) + 1e-15)
@@ -29,6 +47,10 @@ def smoothed_hist_kl_distance(a, b, nbins=20):
                     np.histogram(b, bins=nbins)[0])
     return kl(ahist, bhist)
 
+def _uses_batch_statistics(module):
+    return any(isinstance(sub_module, torch.nn.modules.batchnorm._BatchNorm) and sub_module.training
+               for sub_module in module.modules())
+
 class CustomStatisticGrad:
     '''
     This class collects statistics for each kernel/layer given a pre-trained model and two datasets.
@@ -39,12 +61,67 @@ class CustomStatisticGrad:
     net -> Network architecture.
     pretrained_data_set -> Dataloader points to the dataset the pre-trained network was trained.
     input_test -> Dataloader points to the new task dataset .
+
+    fuse_streams -> Runs the pretrained, new and second pretrained batches through every stage as one concatenated
+                    batch and splits the outputs per stream. Stages holding BatchNorm in training mode run per stream,
+                    so the batch statistics of the datasets are never mixed and the results equal separate forwards;
+                    with the network in eval mode every stage is fused.
+    chunk_size -> Number of buffered samples per stream advanced through a stage with a single forward.
+    activation_store -> Folder of an ActivationStore. The collected activations are written there once, later runs
+                        with the same collection settings are analysed from the memory-mapped files without running the
+                        network.
+    store_dtype -> 'float32' or 'float16', precision of the stored activations.
+    reservoir_size -> Number of values per kernel the hook collection keeps for the kernel mode comparison (reservoir
+                      sampling of the prior transformed values), 0 keeps all of them.
+    seed -> Seed of the reservoir sampling and of the quantile sketch compaction.
+    sketch_size -> Compactor size k of the per kernel quantile sketches of the hook collection. The per kernel values
+                   of all batches are summarized in mergeable sketches instead of being sampled / concatenated, and the
+                   KS / ws similarity is estimated from the sketches. 0 keeps the sampled values.
+    prefetch -> Number of batches every stream loads ahead in a background thread (moved to the device and contiguous),
+                0 iterates the loaders directly.
+    num_workers -> Number of processes the statistics pass is split over. Every worker analyses a contiguous block of
+                   the batches with its own replica of the network, the partial statistics are merged before the
+                   metric phase. CPU only (the workers are forked), the activation store is not written.
+    process_group -> torch.distributed process group (e.g. gloo on CPU) to split the statistics pass over. Every rank
+                     analyses a disjoint block of the batches, the statistics are combined across the ranks, rank 0
+                     runs the metric phase and gradient search and broadcasts layers_grad_mult to the other ranks.
+    precision -> 'float32', 'bfloat16' or 'float16'. The reduced precisions run the forwards and the encoder under
+                 autocast and keep the buffered activations and embeddings of the layer-wise pass in that dtype
+                 (precision_report() shows the resulting drift of the similarity scores).
+    inference_engine -> Runs the statistics pass on a frozen eval mode replica of the network (running BatchNorm
+                        statistics, Conv + BatchNorm folded where possible) under torch.inference_mode. Off by
+                        default: a network in training mode gets other statistics on the eval mode replica.
+    compile_stages -> With the inference engine, compiles the stages of the layer-wise pass with torch.compile.
+    channels_last -> With the inference engine, runs the replica in the channels_last memory format.
+    encoder_path -> Weights of the DeepAutoencoder whose encoder embeds the feature maps of the layer-wise analysis.
+    plot_distributions -> Saves the per kernel distribution plots of the metric phase. Without them the KS / ws
+                          metric phase only runs the vectorized comparison of each layer.
     '''
     def __init__(self, net: torchvision.models , pretrained_data_set: torch.utils.data.DataLoader, input_test:torch.utils.data.DataLoader,
                  dist_processing_method: str='fft', batches_num: int=10, percent: int=70,
                  deepest_layer: int=11,similarity: str='ws', save_folder: str='./',
-                 process_method: str='fft', per_trained_dataset_2=None):
+                 process_method: str='fft', per_trained_dataset_2=None, fuse_streams: bool=True,
+                 chunk_size: int=64, activation_store: str=None, store_dtype: str='float32',
+                 reservoir_size: int=50000, seed: int=0, sketch_size: int=0, plot_distributions: bool=True,
+                 prefetch: int=2, num_workers: int=1, process_group=None, precision: str='float32', inference_engine: bool=False, compile_stages: bool=False, channels_last: bool=False,
+                 encoder_path: str=r'C:\Users\yuval\PycharmProjects\smart_pretrained\Statistics-pretrained\saved_models\diff_net\_encoder_decoder_299'):
         self.process_method=process_method
+        if precision not in PRECISIONS:
+            raise ValueError('precision must be one of ' + ', '.join(PRECISIONS))
+        self.precision = precision
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.process_group = process_group
+        self.inference_engine = inference_engine
+        self.compile_stages = compile_stages
+        self.channels_last = channels_last
+        self.plot_distributions = plot_distributions
+        self.sketch_size = sketch_size
+        self.reservoir_size = reservoir_size
+        self.seed = seed
+        self.activation_store = None if activation_store is None else ActivationStore(activation_store, store_dtype)
+        self.fuse_streams = fuse_streams
+        self.chunk_size = chunk_size
         self.pretrained_data_set = pretrained_data_set
         self.pretrained_data_set2 = per_trained_dataset_2
         self.input_test = input_test
@@ -54,18 +131,21 @@ class CustomStatisticGrad:
         self.num_batches = batches_num
         self.threshold_percent = percent
         self.activation = {}
-        self.batch_size = self.pretrained_data_set.batch_size
+        self.batch_size = loader_batch_size(self.pretrained_data_set)
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.similarity = similarity
         self.save_folder = save_folder
         self.ablation_mode = True
         self.PriorPreprocess =PriorPreprocess
         self.modules_name_list = []
-        self.auto_enc = DeepAutoencoder().cuda()
-        self.auto_enc.load_state_dict(torch.load(r'C:\Users\yuval\PycharmProjects\smart_pretrained\Statistics-pretrained\saved_models\diff_net\_encoder_decoder_299'), strict=True)
+        self.auto_enc = DeepAutoencoder().to(self.device)
+        self.auto_enc.load_state_dict(torch.load(encoder_path, map_location=self.device), strict=True)
+        self.auto_enc.eval()
         self.enc = self.auto_enc.encoder
+        self.folded_enc = FoldedEncoder(self.enc)
     def _plot_distribution(self, ind_layer, layer_pretrained, layer_test,
-                               stats_val=0, method='gram', kernel_num=0, pvalue=0, num_plots=20, ax_sub=None, layer_name=''):
+                               stats_val=0, method='gram', kernel_num=0, pvalue=0, num_plots=20, ax_sub=None, layer_name='',
+            weights_pretrained=None, weights_test=None):
 
             if method != 'gram':
                 # Assuming log normal dist due to relu :
@@ -84,14 +164,14 @@ class CustomStatisticGrad:
                     stats_val, 2)),fontsize=7)
             else:
 
-                values, axis_val = np.histogram(layer_test, 100)
+                values, axis_val = np.histogram(layer_test, 100, weights=weights_test)
                 ax_sub[self.plot_counter ].plot(axis_val[10:], values[9:] / np.max(values[10:]),
                                                 linewidth=4,
                                                 alpha=0.7, label='Dtest')
                 minx_1 = np.min(axis_val[10:])
                 maxx_1 = np.max(axis_val[10:])
 
-                values, axis_val = np.histogram(layer_pretrained, 100)
+                values, axis_val = np.histogram(layer_pretrained, 100, weights=weights_pretrained)
                 ax_sub[self.plot_counter].plot(axis_val[10:],
                                                values[9:] / np.max(values[10:]),
                                                linewidth=4,
@@ -119,12 +199,12 @@ class CustomStatisticGrad:
             fig_pre = plt.figure(1)
             plt.subplot(num_per_axis, num_per_axis,i + 1)
             plt.title('kernel index:' + str(index))
-            plt.imshow(self.activations_input_pre[name_layer][im_batch][index])
+            plt.imshow(self.activations_input_pre[name_layer][im_batch][index].float().cpu().numpy())
 
             fig_new = plt.figure(2)
             plt.subplot(num_per_axis, num_per_axis,i + 1)
             plt.title('kernel index:' + str(index))
-            plt.imshow(self.activations_input_test[name_layer][im_batch][index])
+            plt.imshow(self.activations_input_test[name_layer][im_batch][index].float().cpu().numpy())
 
         fig_bpm = plt.figure(3)
         plt.title('kernel index:' + str(index))
@@ -160,17 +240,46 @@ class CustomStatisticGrad:
                             module.weight.grad *= torch.tensor(np.min([1e-3, (2**epoch) * (np.min(self.layers_grad_mult[name]['weights']))
                                                                     ])).to(self.device)
                         else:
-                            module.weight.grad *= torch.FloatTensor(
-                                self.layers_grad_mult[name]['weights']).to(self.device)
+                            module.weight.grad *= torch.as_tensor(
+                                self.layers_grad_mult[name]['weights'], dtype=torch.float32, device=self.device)
                             if module.bias != None:
-                                module.bias.grad *= torch.FloatTensor(
-                                    np.squeeze(self.layers_grad_mult[name]['bias'])).to(self.device)
+                                module.bias.grad *= torch.as_tensor(
+                                    np.squeeze(self.layers_grad_mult[name]['bias']), dtype=torch.float32,
+                                    device=self.device)
+
+    def gradient_masks(self, net, mode='normal', until_epoch=None):
+        '''
+        The masks found by run() as tensor hooks on the parameters of net, replacing update_grads after every backward.
+        '''
+        return GradientMasks(net, self.layers_grad_mult, self.modules_name_list, mode=mode, until_epoch=until_epoch)
+
+    def hard_freeze(self, net, threshold=1e-6):
+        # Layers frozen by the per_layer search stop requiring gradients instead of having them scaled away
+        first_trainable = hard_freeze(net, self.layers_grad_mult, threshold=threshold)
+        print('hard freeze, backpropagation stops at: ' + str(first_trainable))
+        return first_trainable
+
+    def save_grad_masks(self, path):
+        # The masks are per output channel vectors / per layer scalars, the file is a few KB
+        np.savez(path, **{name + ':' + kind: mask for name, masks in self.layers_grad_mult.items()
+                          for kind, mask in masks.items()})
+
+    def load_grad_masks(self, path):
+        self.layers_grad_mult = defaultdict(dict)
+        with np.load(path) as masks:
+            for key in masks.files:
+                name, kind = key.rsplit(':', 1)
+                self.layers_grad_mult[name][kind] = masks[key]
 
     def get_activation(self, name):
+        # Keeps the activation on its device and reduces it into the per-channel statistics of the current stream.
         def hook(_, __, output):
             try:
-                self.activation[name] = output.detach().cpu().numpy().copy()
-                if (np.sum(np.abs(output.detach().cpu().numpy()) <=1e-8  ) > 1000):
+                output = output.detach()
+                self.activation[name] = output
+                self.activation_shapes[name] = tuple(output.shape[1:])
+                batch_zeros = self.channel_stats[self._stream][name].update(output)
+                if int(batch_zeros.sum()) > 1000:
                     print('errr')
             except:
                 self.activation[name] = None
@@ -182,14 +291,21 @@ class CustomStatisticGrad:
         self.input_test_iter = map(lambda v: v[0].to(self.device), self.input_test)
 
     def _prepare_input_tensor(self):
-        self.pretrained_iter = self.pretrained_data_set
-        self.input_test_iter =self.input_test
-        self.pretrained_iter2 =self.pretrained_data_set2
+        self.pretrained_iter = self._prefetched(self.pretrained_data_set)
+        self.input_test_iter = self._prefetched(self.input_test)
+        self.pretrained_iter2 = self._prefetched(self.pretrained_data_set2)
+
+    def _prefetched(self, loader):
+        # Every stream is loaded ahead in its own background thread, so the three streams load concurrently
+        if loader is None or self.prefetch <= 0:
+            return loader
+        return BackgroundLoader(loader, depth=self.prefetch, device=self.device)
 
     def _hook_assign_module(self):
         self.modules_name_list = []
         hooks = {}
-        for ind, (name, module) in enumerate(self.network.named_modules()):
+        self.hooks = hooks
+        for ind, (name, module) in enumerate(self.analysis_network.named_modules()):
             #if ind > self.max_layer:
             #    break
             # body.2.conv2
@@ -202,7 +318,7 @@ class CustomStatisticGrad:
                     self.get_activation(name))
 
 
-    def _calc_layers_outputs(self, batches_num=10, mode='normal'):
+    def _calc_hooked_layers_outputs(self, batches_num=10, mode='normal'):
         ## Hook to each relavant module
         self._hook_assign_module()
 
@@ -213,21 +329,28 @@ class CustomStatisticGrad:
                 break
             self.activation = {} # clear all activations every batch
 
-            bp = input_model[0].to(self.device, dtype=torch.float)
-            bp_test = input_test[0].to(self.device, dtype=torch.float)
+            bp = self._prepare_batch(input_model[0])
+            bp_test = self._prepare_batch(input_test[0])
 
-            self.network(bp)
+            self._stream = 'pre'
+            self.analysis_network(bp)
             self.activations_input_pre = self.activation.copy()
             self.activation = {}
-            self.network(bp_test)
+            self._stream = 'test'
+            self.analysis_network(bp_test)
             self.activations_input_test = self.activation.copy()
             values_post_test = 0
             values_post_pre = 0
 
             for name in self.modules_name_list:
                 if self.activations_input_test[name] is not None:
-                    dist_new = self.activations_input_test[name].copy()
-                    values_pre = self.activations_input_pre[name].copy()
+                    if self.activation_store is not None:
+                        capacity = (batches_num + 1) * self.batch_size
+                        self.activation_store.append('activations', name, 'pre', self.activations_input_pre[name], capacity)
+                        self.activation_store.append('activations', name, 'test', self.activations_input_test[name], capacity)
+                    # Raw values are only needed on the host for the prior transformation
+                    dist_new = self.activations_input_test[name].float().cpu().numpy()
+                    values_pre = self.activations_input_pre[name].float().cpu().numpy()
                     if mode=='per_layer':
                         out_new = self.gram_layer(dist_new)
                         out_pre = self.gram_layer(values_pre)
@@ -235,20 +358,11 @@ class CustomStatisticGrad:
                         self.statistic_test[name].append(np.ravel(out_new))
                         self.statistic_pretrained[name].append(np.ravel(out_pre))
                     else:
-                        dist_new_tot_size_per_ch = None
-                        dist_pre_tot_size_per_ch = None
                         if len(np.shape(dist_new)) > 2:
                             ## seperating distribution per kernel
                             # -> [#channels, #BatchSIze,#activation size (#,#) ]
                             dist_new_channel_first = np.transpose(dist_new, [1, 0, 2, 3])
-                            dist_new_tot_size_per_ch = np.zeros(((np.shape(dist_new_channel_first)[0],
-                                                                  np.prod(np.shape(dist_new_channel_first)
-                                                                          [1:]))))
-
                             values_pre_channel_first = np.transpose(values_pre, [1, 0, 2, 3])
-                            dist_pre_tot_size_per_ch = np.zeros(((np.shape(values_pre_channel_first)[0],
-                                                                  np.prod(np.shape(values_pre_channel_first)
-                                                                          [1:]))))
 
                             # Required shape per channel:
                             transform_prior = self.PriorPreprocess(method=self.process_method, shape_act=np.shape(dist_new), **self.__dict__)
@@ -258,24 +372,23 @@ class CustomStatisticGrad:
                             ## Aggragating along in a dict for each  channel:
 
                             for ll in range(np.shape(dist_new_channel_first)[0]):
-                                dist_new_tot_size_per_ch[ll] = \
-                                    np.ravel(dist_new_channel_first[ll])
-                                dist_pre_tot_size_per_ch[ll] = \
-                                    np.ravel(values_pre_channel_first[ll])
                                 values_post_test[ll] = transform_prior.run_prior_transformation(
                                     dist_new_channel_first[ll])
                                 values_post_pre[ll] = transform_prior.run_prior_transformation(
                                     values_pre_channel_first[ll])
-                            if len(dist_pre_tot_size_per_ch[0]) > 200e3:
-                                dist_new_tot_size_per_ch = dist_new_tot_size_per_ch[
-                                                           :, np.random.randint(
-                                    0, len(dist_pre_tot_size_per_ch[0]), size=5000)]
-                                dist_pre_tot_size_per_ch = dist_pre_tot_size_per_ch[:, np.random.randint(
-                                    0, len(dist_pre_tot_size_per_ch[0]), size=5000)]
+                        if self.sketch_size > 0:
+                            # The sketches replace the concatenation, memory no longer grows with the batches
+                            self._update_sketches(name, values_post_test, values_post_pre)
+                        elif self.reservoir_size > 0 and np.ndim(values_post_test) == 2:
+                            # Bounded per kernel samples instead of the concatenation along the batches
+                            self._update_reservoirs(name, values_post_test, values_post_pre)
                         # Concatanating the data along the different batches :
-                        if len(np.shape(self.stats_test[name])) == 0:
+                        elif len(np.shape(self.stats_test[name])) == 0 and self._raw_first_batch:
                             self.stats_test[name] = values_post_test
                             self.pre_trained_outputs[name] = values_post_pre
+                        elif len(np.shape(self.stats_test[name])) == 0:
+                            self.stats_test[name] = np.clip(np.abs(values_post_test), -2e6, 2e6)
+                            self.pre_trained_outputs[name] = np.clip(np.abs(values_post_pre), -2e6, 2e6)
                         else:
                             clipped_log_gram = np.clip(
                                 (np.abs(values_post_test)), -2e6, 2e6)
@@ -283,19 +396,40 @@ class CustomStatisticGrad:
                                 [self.stats_test[name], clipped_log_gram], axis=1)
                             self.pre_trained_outputs[name] = np.concatenate(
                                 [self.pre_trained_outputs[name], np.clip((np.abs(values_post_pre)), -2e6, 2e6)], axis=1)
-                        self.statistic_test[name].append(dist_new_tot_size_per_ch)
-                        self.statistic_pretrained[name].append(dist_pre_tot_size_per_ch)
 
             #self.bpm = bpm
             #self.bpm_test = bpm_test
+        for hook in self.hooks.values():
+            hook.remove()
+        if mode != 'per_layer':
+            self._reservoir_statistics()
+
+    def _update_reservoirs(self, name, values_post_test, values_post_pre):
+        # Values after the first batch are clipped, as the concatenation does
+        for stream, values in (('test', values_post_test), ('pre', values_post_pre)):
+            reservoir = self.channel_reservoirs[stream][name]
+            if reservoir.seen > 0 or not self._raw_first_batch:
+                values = np.clip(np.abs(values), -2e6, 2e6)
+            # [#channels, #values] -> [1, #channels, #values]
+            reservoir.update(torch.from_numpy(np.ascontiguousarray(values)).unsqueeze(0))
+
+    def _reservoir_statistics(self):
+        # The per kernel values of the KS / ws comparison are the bounded samples the reservoirs kept
+        for name in self.modules_name_list:
+            if name in self.channel_reservoirs['test']:
+                self.stats_test[name] = self.channel_reservoirs['test'][name].samples().float().cpu().numpy()
+                self.pre_trained_outputs[name] = self.channel_reservoirs['pre'][name].samples().float().cpu().numpy()
 
     def _calc_layers_outputs(self, batches_num=10, mode='normal'):
-        output_pre = []
-        output_test = []
-        output_pre2 = []
-        out_feature_store_pre = []
-        out_feature_store_test =[]
-        out_feature_store_pre2 = []
+        # Buffers are preallocated for all the analysed batches and grow only if a loader yields larger batches
+        capacity = (batches_num + 1) * self.batch_size
+        storage_dtype = PRECISIONS[self.precision]
+        output_pre = GrowableBuffer(capacity, dtype=storage_dtype)
+        output_test = GrowableBuffer(capacity, dtype=storage_dtype)
+        output_pre2 = GrowableBuffer(capacity, dtype=storage_dtype)
+        out_feature_store_pre = GrowableBuffer(capacity, dtype=storage_dtype)
+        out_feature_store_test = GrowableBuffer(capacity, dtype=storage_dtype)
+        out_feature_store_pre2 = GrowableBuffer(capacity, dtype=storage_dtype)
 
     #### Runs over the first layer.
         if self.pretrained_iter2 is not None:
@@ -309,153 +443,103 @@ class CustomStatisticGrad:
             else:
                 input_model, input_test = tuple_out
 
-            bp = input_model[0].to(self.device, dtype=torch.float)
-            bp_test = input_test[0].to(self.device, dtype=torch.float)
-            bp_2 = input_pre2[0].to(self.device, dtype=torch.float)
+            bp = self._prepare_batch(input_model[0])
+            bp_test = self._prepare_batch(input_test[0])
+            bp_2 = self._prepare_batch(input_pre2[0])
 
-            module_f = list(self.network.children())[0]
+            module_f = self._analysis_stages()[0]
             name_module = list(self.network.named_modules())[1][0]
-            feature_l = module_f.forward(bp)
-            feature_l_test = module_f.forward(bp_test)
-            feature_l2 = module_f.forward(bp_2)
+            feature_l, feature_l_test, feature_l2 = self._forward_streams(module_f, [bp, bp_test, bp_2])
+            self._update_channel_stats(name_module, feature_l, feature_l_test, feature_l2)
 
             self.pre_feature = True
             if self.pre_feature:
-                for feature_b_pre, feature_b_test, feature_b_pre2 in zip(feature_l, feature_l_test, feature_l2):
-                    resized_tensor_pre = F.interpolate(feature_b_pre.squeeze().unsqueeze(1) , size=(64, 64), mode='nearest')
-                    resized_tensor_test = F.interpolate(feature_b_test.squeeze().unsqueeze(1) , size=(64, 64), mode='nearest')
-                    resized_tensor_pre2 = F.interpolate(feature_b_pre2.squeeze().unsqueeze(1) , size=(64, 64), mode='nearest')
-
-                    out_encs_pre = self.enc(resized_tensor_pre.view(-1, 64*64))
-                    out_encs_test = self.enc(resized_tensor_test.view(-1, 64*64))
-                    out_encs_pre2 = self.enc(resized_tensor_pre2.view(-1, 64*64))
-
-                    if len(out_feature_store_pre) > 0:
-                        out_feature_store_pre = torch.cat([out_feature_store_pre ,out_encs_pre.unsqueeze(0)] ,dim=0)
-                        out_feature_store_test = torch.cat([out_feature_store_test , out_encs_test.unsqueeze(0)] ,dim=0)
-                        out_feature_store_pre2 = torch.cat([out_feature_store_pre2 ,out_encs_pre2.unsqueeze(0)] ,dim=0)
-
-                    else:
-                        out_feature_store_pre = out_encs_pre.unsqueeze(0)
-                        out_feature_store_test = out_encs_test.unsqueeze(0)
-                        out_feature_store_pre2 = out_encs_pre2.unsqueeze(0)
+                out_encs_pre, out_encs_test, out_encs_pre2 = self._encode_streams([feature_l, feature_l_test, feature_l2])
+                out_feature_store_pre.append(out_encs_pre)
+                out_feature_store_test.append(out_encs_test)
+                out_feature_store_pre2.append(out_encs_pre2)
 
-                out_feature_store_pre_nump = np.transpose(out_feature_store_pre.cpu().detach().numpy(), [1,0,2])
-                out_feature_store_test_nump = np.transpose(out_feature_store_test.cpu().detach().numpy(), [1,0,2])
-                out_feature_store_pre_nump2 = np.transpose(out_feature_store_pre2.cpu().detach().numpy(), [1,0,2])
+            output_pre.append(feature_l)
+            output_test.append(feature_l_test)
+            output_pre2.append(feature_l2)
 
-            if len(output_pre) > 0:
-                output_pre = torch.cat([output_pre ,feature_l] ,dim=0)
-                output_test = torch.cat([output_test , feature_l_test] ,dim=0)
-                output_pre2 = torch.cat([output_pre2 ,feature_l2] ,dim=0)
+        output_pre = output_pre.view()
+        output_test = output_test.view()
+        output_pre2 = output_pre2.view()
+        self._store_stage(name_module, [output_pre, output_test, output_pre2],
+                          [out_feature_store_pre.view(), out_feature_store_test.view(), out_feature_store_pre2.view()])
 
-            else:
-                output_pre = module_f.forward(bp)
-                output_test = module_f.forward(bp_test)
-                output_pre2 = module_f.forward(bp_2)
-
-        output_test_nump = np.transpose(output_test.cpu().detach().numpy(), [1,0,2,3])
-        output_pre_nump = np.transpose(output_pre.cpu().detach().numpy(), [1,0,2,3])
-        output_pre_nump2 = np.transpose(output_pre2.cpu().detach().numpy(), [1,0,2,3])
-        sim_ch =[]
         self.kernel_mean = defaultdict(list)
         self.kernel_std = defaultdict(list)
-        if len(list(module_f._modules)) < 2 and \
-                'weight' in module_f._parameters and 'Conv'  in module_f._get_name() :  # Skip module modules
+        first_module = list(self.network.children())[0]
+        if len(list(first_module._modules)) < 2 and \
+                'weight' in first_module._parameters and 'Conv'  in first_module._get_name() :  # Skip module modules
             self.modules_name_list.append(name_module)
 
-
-        for out_test_ch,output_pre_ch, output_pre_ch2, out_enc_pre_ch, out_enc_test_ch, out_enc_pre_ch2  \
-        in zip(output_test_nump,output_pre_nump,output_pre_nump2,out_feature_store_pre_nump,out_feature_store_test_nump, out_feature_store_pre_nump2):
-            """
-            Compansate forwarding distribution from non similar kernels to later similar kernels.
-            There is a possiblitly that a generalized kernel in the later layers wont be identified as a generalized due to out of distribution input from previous layers.
-            We want to match the distribution of the source in order to eliminate/ reduce such cases.
-            By doing the following:
-            1.Calculating addition value for the mean of each kernel in order to distribute the same as the source.
-            2.Calculating the multiplication needed for the std in order to distribute the same.
-            Than we forward our input layer by layer, before we forward pass to the next layer, we modify it's mean and std values of the kernels that identified as non-generalized kernels.
-            """
-            # Calculate the similarity:
-
-            #sim_ch.append(kl(np.ravel(out_test_ch_transform), np.ravel(output_pre_ch_transform)) )
-            kl_out =  self.calculate_kl_divergence(out_enc_pre_ch, out_enc_test_ch)
-            kl_out2 =  self.calculate_kl_divergence(out_enc_pre_ch, out_enc_pre_ch2)
-            simm_ratio_kl = kl_out * kl_out2 # The ratio between the kl of the pretrained vs other pre-trained and pretrained with test dataset
-            sim_ch.append(1 / simm_ratio_kl )
-
-        # Calculate the required mean and std:
-            self.kernel_mean[name_module].append(np.mean(-1*np.ravel(out_test_ch)) + np.mean(np.ravel(output_pre_ch)))
-            self.kernel_std[name_module].append( np.std(np.ravel(output_pre_ch)) / np.std(np.ravel(out_test_ch)))
+        """
+        Compansate forwarding distribution from non similar kernels to later similar kernels.
+        There is a possiblitly that a generalized kernel in the later layers wont be identified as a generalized due to out of distribution input from previous layers.
+        We want to match the distribution of the source in order to eliminate/ reduce such cases.
+        By doing the following:
+        1.Calculating addition value for the mean of each kernel in order to distribute the same as the source.
+        2.Calculating the multiplication needed for the std in order to distribute the same.
+        Than we forward our input layer by layer, before we forward pass to the next layer, we modify it's mean and std values of the kernels that identified as non-generalized kernels.
+        """
+        # Calculate the similarity and the required mean and std:
+        sim_ch = self._stage_similarity(name_module, out_feature_store_pre.view(), out_feature_store_test.view(),
+                                        out_feature_store_pre2.view())
         # Here we chose a hard threshold. - Should be parametrized by the user.
         bad_sim = sim_ch  < np.mean(sim_ch)
-        L = len(list(self.network.children()))
+        stages = self._analysis_stages()
+        L = len(stages)
         name_module = list(self.network.named_modules())[1][0]
 
         self.stats_value_per_layer[name_module] = sim_ch
-        for index_module, module_f in enumerate(list(self.network.children())[1: L - 1 ]):
-            output_pre_new = []
-            output_pre_new2 = []
-            output_test_new = []
-            out_feature_store_pre = []
-            out_feature_store_test =[]
-            out_feature_store_pre2 = []
-
-            inds_replace = np.where(bad_sim)[0]
-            for indr in inds_replace:
-                indr = int(indr)
-                output_test[:,torch.tensor(indr, device='cuda')]  = (output_test[:, torch.tensor(indr, device='cuda')] +  self.kernel_mean[name_module][indr] ) * self.kernel_std[name_module][indr]
-
-            for ind in range(len(output_pre) - 1):
-                #print(ind)## Continue later.
-                feature_l = module_f.forward(output_pre[ind].unsqueeze(0))
-                feature_l_test = module_f.forward(output_test[ind].unsqueeze(0))
-                feature_l2 = module_f.forward(output_pre2[ind].unsqueeze(0))
+        for index_module, module_f in enumerate(stages[1: L - 1 ]):
+            num_samples = max(len(output_pre), len(output_test), len(output_pre2))
+            output_pre_new = GrowableBuffer(num_samples, dtype=storage_dtype)
+            output_pre_new2 = GrowableBuffer(num_samples, dtype=storage_dtype)
+            output_test_new = GrowableBuffer(num_samples, dtype=storage_dtype)
+            out_feature_store_pre = GrowableBuffer(num_samples, dtype=storage_dtype)
+            out_feature_store_test = GrowableBuffer(num_samples, dtype=storage_dtype)
+            out_feature_store_pre2 = GrowableBuffer(num_samples, dtype=storage_dtype)
+
+            name_module_next = list(self.network.named_modules())[index_module + 2][0]
+            inds_replace = torch.as_tensor(np.where(bad_sim)[0], device=output_test.device)
+            if len(inds_replace) > 0:
+                broadcast_shape = (1, -1) + (1,) * (output_test.dim() - 2)
+                kernel_mean = torch.tensor(self.kernel_mean[name_module], dtype=output_test.dtype,
+                                           device=output_test.device)[inds_replace].view(broadcast_shape)
+                kernel_std = torch.tensor(self.kernel_std[name_module], dtype=output_test.dtype,
+                                          device=output_test.device)[inds_replace].view(broadcast_shape)
+                output_test[:, inds_replace] = (output_test[:, inds_replace] + kernel_mean) * kernel_std
+
+            # All buffered samples are advanced through the stage in chunks of chunk_size, one forward per chunk.
+            for chunk_start in range(0, num_samples, self.chunk_size):
+                chunk = slice(chunk_start, chunk_start + self.chunk_size)
+                feature_l, feature_l_test, feature_l2 = self._forward_streams(
+                    module_f, [output_pre[chunk], output_test[chunk], output_pre2[chunk]])
+                self._update_channel_stats(name_module_next, feature_l, feature_l_test, feature_l2)
 
                 self.pre_feature = True
                 if self.pre_feature:
-                    for feature_b_pre, feature_b_test, feature_b_pre2 in zip(feature_l, feature_l_test, feature_l2):
-                        resized_tensor_pre = F.interpolate(feature_b_pre.squeeze().unsqueeze(1) , size=(64, 64), mode='nearest')
-                        resized_tensor_test = F.interpolate(feature_b_test.squeeze().unsqueeze(1) , size=(64, 64), mode='nearest')
-                        resized_tensor_pre2 = F.interpolate(feature_b_pre2.squeeze().unsqueeze(1) , size=(64, 64), mode='nearest')
-
-                        out_encs_pre2 = self.enc(resized_tensor_pre2.view(-1, 64*64))
-                        out_encs_pre = self.enc(resized_tensor_pre.view(-1, 64*64))
-                        out_encs_test = self.enc(resized_tensor_test.view(-1, 64*64))
-
-                        if len(out_feature_store_pre) > 0:
-                            out_feature_store_pre2 = torch.cat([out_feature_store_pre2 ,out_encs_pre2.unsqueeze(0)] ,dim=0)
-                            out_feature_store_pre = torch.cat([out_feature_store_pre ,out_encs_pre.unsqueeze(0)] ,dim=0)
-                            out_feature_store_test = torch.cat([out_feature_store_test , out_encs_test.unsqueeze(0)] ,dim=0)
-                        else:
-                            out_feature_store_pre = out_encs_pre.unsqueeze(0)
-                            out_feature_store_pre2 = out_encs_pre2.unsqueeze(0)
-                            out_feature_store_test = out_encs_test.unsqueeze(0)
-                    out_feature_store_pre_nump = np.transpose(out_feature_store_pre.cpu().detach().numpy(), [1,0,2])
-                    out_feature_store_pre_nump2 = np.transpose(out_feature_store_pre2.cpu().detach().numpy(), [1,0,2])
-                    out_feature_store_test_nump = np.transpose(out_feature_store_test.cpu().detach().numpy(), [1,0,2])
-
-                if len(output_pre_new) > 0:
-                    output_pre_new2 = torch.cat([output_pre_new2 , module_f.forward(output_pre2[ind].unsqueeze(0))] ,dim=0)
-                    output_pre_new = torch.cat([output_pre_new , module_f.forward(output_pre[ind].unsqueeze(0))] ,dim=0)
-                    output_test_new = torch.cat([output_test_new , module_f.forward(output_test[ind].unsqueeze(0))] ,dim=0)
-                else:
-                    output_pre_new = module_f.forward(output_pre[ind].unsqueeze(0))
-                    output_test_new = module_f.forward(output_test[ind].unsqueeze(0) )
-                    output_pre_new2 = module_f.forward(output_pre2[ind].unsqueeze(0))
-
-
-            output_test_nump = np.transpose(output_test_new.cpu().detach().numpy(), [1,0,2,3])
-            output_pre_nump = np.transpose(output_pre_new.cpu().detach().numpy(), [1,0,2,3])
-            output_pre_nump2 = np.transpose(output_pre_new2.cpu().detach().numpy(), [1,0,2,3])
-            sim_ch =[]
-            name_module = list(self.network.named_modules())[index_module + 2][0]
-
-            for out_test_ch,output_pre_ch,output_pre_ch2, out_enc_pre_ch, out_enc_test_ch ,out_enc_pre_ch2 in zip(output_test_nump,output_pre_nump,output_pre_nump2,out_feature_store_pre_nump,out_feature_store_test_nump,out_feature_store_pre_nump2):
-                kl_out1 =  self.calculate_kl_divergence(out_enc_pre_ch, out_enc_test_ch)
-                kl_out2 =  self.calculate_kl_divergence(out_enc_pre_ch, out_enc_pre_ch2)
-                simm_ratio_kl = kl_out1 * kl_out2
-                sim_ch.append(1 / simm_ratio_kl )
+                    out_encs_pre, out_encs_test, out_encs_pre2 = self._encode_streams(
+                        [feature_l, feature_l_test, feature_l2])
+                    out_feature_store_pre2.append(out_encs_pre2)
+                    out_feature_store_pre.append(out_encs_pre)
+                    out_feature_store_test.append(out_encs_test)
+
+                output_pre_new2.append(feature_l2)
+                output_pre_new.append(feature_l)
+                output_test_new.append(feature_l_test)
+
+            self._store_stage(name_module_next, [output_pre_new.view(), output_test_new.view(), output_pre_new2.view()],
+                              [out_feature_store_pre.view(), out_feature_store_test.view(), out_feature_store_pre2.view()])
+
+            name_module = name_module_next
+
+            sim_ch = self._stage_similarity(name_module, out_feature_store_pre.view(), out_feature_store_test.view(),
+                                            out_feature_store_pre2.view())
                 ## Store in a fio
                 #from mpl_toolkits.mplot3d import Axes3D
 #
@@ -479,8 +563,6 @@ class CustomStatisticGrad:
 #
                 ## Show the plot
                 #plt.show()
-                self.kernel_mean[name_module].append(np.mean(-1*np.ravel(out_test_ch)) + np.mean(np.ravel(output_pre_ch)))
-                self.kernel_std[name_module].append( np.std(np.ravel(output_pre_ch)) / np.std(np.ravel(out_test_ch)))
             self.stats_value_per_layer[name_module] = sim_ch
 
             self.modules_name_list.append(name_module)
@@ -494,9 +576,151 @@ class CustomStatisticGrad:
 
 
             bad_sim = sim_ch  < np.mean(sim_ch) * 1.1
-            output_pre = output_pre_new.clone()
-            output_test = output_test_new.clone()
-            output_pre2 = output_pre_new2.clone()
+            # The stage buffers are owned by this loop, so their views replace the previous stage without a copy
+            output_pre = output_pre_new.view()
+            output_test = output_test_new.view()
+            output_pre2 = output_pre_new2.view()
+
+    def _forward_streams(self, module_f, stream_inputs):
+        '''
+        Runs module_f once over the concatenation of the streams batches and splits the output back by stream.
+        Layers that normalize with batch statistics (BatchNorm in training mode) would mix the streams, so they are run
+        per stream.
+        '''
+        if not self.fuse_streams or _uses_batch_statistics(module_f):
+            return [module_f(stream_input).detach() for stream_input in stream_inputs]
+        stream_sizes = [len(stream_input) for stream_input in stream_inputs]
+        fused_output = module_f(torch.cat(stream_inputs, dim=0)).detach()
+        return list(torch.split(fused_output, stream_sizes, dim=0))
+
+    def _analysis_stages(self):
+        # Stages the layer-wise pass runs, the ones of the analysis replica when the inference engine is used
+        if self.engine is None:
+            return list(self.network.children())
+        return self.engine.stages()
+
+    def _prepare_batch(self, values):
+        if self.engine is None:
+            return values.to(self.device, dtype=torch.float)
+        return self.engine.prepare_input(values, self.device)
+
+    def _encode_streams(self, stream_features):
+        '''
+        Encoder embeddings [#BatchSize, #channels, 4] of the feature maps of every stream. The channels of all the
+        samples and streams are encoded with a single forward of the encoder, at their native resolution (the
+        upsampling to 64x64 is folded into the first encoder layer).
+        '''
+        stream_sizes = [len(features) for features in stream_features]
+        features = torch.cat(stream_features, dim=0)
+        num_samples, num_channels = features.shape[:2]
+        with torch.no_grad():
+            embeddings = self.folded_enc(features.reshape(num_samples * num_channels, *features.shape[2:])).view(
+                num_samples, num_channels, -1)
+        return list(torch.split(embeddings, stream_sizes, dim=0))
+
+    def _update_channel_stats(self, name, *stream_outputs):
+        for stream, output in zip(STREAMS, stream_outputs):
+            self.activation_shapes[name] = tuple(output.shape[1:])
+            self.channel_stats[stream][name].update(output)
+
+    def _stage_similarity(self, name, embeddings_pre, embeddings_test, embeddings_pre2):
+        # Similarity of the kernels of a finished stage and the moments to compensate them. Parallel collection
+        # workers exchange their partial statistics for the ones of all the samples.
+        if self._stage_exchange is not None:
+            return self._stage_exchange.stage_similarity(self, name, [embeddings_pre, embeddings_test, embeddings_pre2])
+        sim_ch = self._embedding_similarity(embeddings_pre, embeddings_test, embeddings_pre2)
+        self._kernel_moments(name)
+        return sim_ch
+
+    def _embedding_similarity(self, embeddings_pre, embeddings_test, embeddings_pre2, channel_first=False):
+        '''
+        Similarity of every channel from the encoder embeddings [#samples, #channels, #dims] of the three streams:
+        1 / (KL(pre, test) * KL(pre, pre2)), the histograms of all channels are computed at once on the bins of pre.
+        '''
+        if not channel_first:
+            embeddings_pre, embeddings_test, embeddings_pre2 = [embeddings.transpose(0, 1) for embeddings in
+                                                                (embeddings_pre, embeddings_test, embeddings_pre2)]
+        kl_test, kl_pre2 = batched_histogramdd_kl(embeddings_pre, [embeddings_test, embeddings_pre2])
+        # The ratio between the kl of the pretrained vs other pre-trained and pretrained with test dataset
+        return list((1 / (kl_test * kl_pre2)).cpu().numpy())
+
+    def _kernel_moments(self, name):
+        # Mean shift and std ratio which match the new dataset activations of every kernel to the pretrained ones
+        stats_pre = self.channel_stats['pre'][name]
+        stats_test = self.channel_stats['test'][name]
+        self.kernel_mean[name] = (stats_pre.mean - stats_test.mean).tolist()
+        self.kernel_std[name] = (stats_pre.std / stats_test.std).tolist()
+
+    def _store_stage(self, name, stream_outputs, stream_embeddings):
+        # Writes a finished stage of the layer-wise pass, before the next stage compensates it in place
+        if self.activation_store is None:
+            return
+        self.stored_stages.append(name)
+        for stream, output, embedding in zip(STREAMS, stream_outputs, stream_embeddings):
+            self.activation_store.write('activations', name, stream, output)
+            self.activation_store.write('embeddings', name, stream, embedding)
+            self.activation_store.write_summary(name, stream, self.channel_stats[stream][name].summary())
+
+    def _store_config(self, collection):
+        # Settings which change the collected activations. similarity, process_method and percent are not part of
+        # it, those can be changed on a stored collection.
+        return {'collection': collection, 'batches_num': self.num_batches, 'batch_size': self.batch_size,
+                'deepest_layer': self.max_layer, 'precision': self.precision}
+
+    def _load_stored_outputs(self, mode='normal', collection='layer_wise'):
+        '''
+        Restores what the statistics pass produces from the activation store. The stored layers are read lazily,
+        a channel is only loaded (and transformed) when the metric phase reaches it.
+        '''
+        store = self.activation_store
+        self.modules_name_list = list(store.metadata['modules'])
+        if collection == 'hooks':
+            for name in self.modules_name_list:
+                if not store.contains('activations', name, 'test'):
+                    continue
+                values_test = store.read('activations', name, 'test')
+                values_pre = store.read('activations', name, 'pre')
+                self.activation_shapes[name] = (values_test.shape[0],) + tuple(values_test.shape[2:])
+                if mode == 'per_layer':
+                    self.statistic_test[name].append(np.ravel(self.gram_layer(np.transpose(values_test, [1, 0, 2, 3]))))
+                    self.statistic_pretrained[name].append(np.ravel(self.gram_layer(np.transpose(values_pre, [1, 0, 2, 3]))))
+                else:
+                    transform_prior = self.PriorPreprocess(method=self.process_method,
+                                                           shape_act=(self.batch_size,) + self.activation_shapes[name],
+                                                           **self.__dict__)
+                    transform = lambda channel, transform_prior=transform_prior: transform_prior.transform_batches(
+                        channel, self.batch_size)
+                    self.stats_test[name] = LazyChannels(values_test, transform)
+                    self.pre_trained_outputs[name] = LazyChannels(values_pre, transform)
+                    self.statistic_test[name] = values_test
+                    self.statistic_pretrained[name] = values_pre
+            return
+        self.kernel_mean = defaultdict(list)
+        self.kernel_std = defaultdict(list)
+        for name in store.metadata['stages']:
+            # Stored embeddings are channel first already
+            embeddings = [torch.as_tensor(np.asarray(store.read('embeddings', name, stream))) for stream in STREAMS]
+            self.stats_value_per_layer[name] = self._embedding_similarity(*embeddings, channel_first=True)
+            summary_pre = store.summary(name, 'pre')
+            summary_test = store.summary(name, 'test')
+            self.kernel_mean[name] = list(summary_pre['mean'] - summary_test['mean'])
+            self.kernel_std[name] = list(summary_pre['std'] / summary_test['std'])
+            values_pre = store.read('activations', name, 'pre')
+            self.activation_shapes[name] = (values_pre.shape[0],) + tuple(values_pre.shape[2:])
+
+    def _update_sketches(self, name, values_post_test, values_post_pre):
+        # Same values as the concatenation: the first batch as is, the later ones absolute and clipped
+        for stream, values in (('test', values_post_test), ('pre', values_post_pre)):
+            sketch = self.channel_sketches[stream][name]
+            if sketch.count > 0 or not self._raw_first_batch:
+                values = np.clip(np.abs(values), -2e6, 2e6)
+            sketch.update(torch.as_tensor(np.asarray(values, dtype=np.float32)))
+
+    def _summarize_channel_stats(self):
+        # Only the small per channel summaries are moved to NumPy
+        self.channel_summaries = {stream: {name: channel_stats.summary()
+                                           for name, channel_stats in self.channel_stats[stream].items()}
+                                  for stream in STREAMS}
 
     def gram_layer(self, dist_new):
         b_size, num_filters, w, h = np.shape(dist_new)
@@ -508,37 +732,48 @@ class CustomStatisticGrad:
         for ind_layer, name in enumerate(self.modules_name_list):
             if ind_layer > self.max_layer:
                 break
-            num_plots = np.shape(self.pre_trained_outputs[name])[0]
-            fig = plt.figure(ind_layer, figsize=(20, 20))
-            ax_sub = fig.subplots(int(np.ceil(np.sqrt(num_plots))), int(np.ceil(np.sqrt(num_plots))))
-            ax_sub = ax_sub.ravel()
+            num_plots = len(self.pre_trained_outputs[name])
+            if self.plot_distributions:
+                fig = plt.figure(ind_layer, figsize=(20, 20))
+                ax_sub = fig.subplots(int(np.ceil(np.sqrt(num_plots))), int(np.ceil(np.sqrt(num_plots))))
+                ax_sub = ax_sub.ravel()
             stats_value = []
             self.plot_counter = 0
-            if np.size(self.stats_test[name]) > 1:  # check if has values
+            if isinstance(self.stats_test[name], LazyChannels) or np.size(self.stats_test[name]) > 1:  # check if has values
+                if self.similarity in ('KS', 'ws'):
+                    # All kernels of the layer are compared in one vectorized pass
+                    layer_sims = layer_similarity(self.stats_test[name], self.pre_trained_outputs[name],
+                                                  similarity=self.similarity, device=self.device)
+                    if not self.plot_distributions:
+                        if np.prod(self.activation_shapes[name][1:]) > 20:
+                            stats_value = list(layer_sims)
+                        else:
+                            stats_value = [[-1]] * len(layer_sims)
+                        self.stats_value_per_layer[name] = stats_value.copy()
+                        continue
                 for ind_inside_layer, (test, pre) in enumerate(zip(
                         self.stats_test[name], self.pre_trained_outputs[name])):
-                    if np.size(self.activations_input_pre[name][0][ind_inside_layer]) > 20:
+                    if np.prod(self.activation_shapes[name][1:]) > 20:
                         ## Convert from log normal to normal distribution. (assumtion been made)
                         test_in = np.log(np.abs(test[np.abs(test) > 1e-7]))
                         pre_in =  np.log(np.abs(pre[np.abs(pre)  > 1e-7]))
                         ## Similarity units! regardless of the test
-                        if len(test_in) > 20 and len(pre_in) > 20: # Chekck there are enought values for statistics
-                            if self.similarity == 'KS':
-                                sim = 1/(1e-8 + stats.ks_2samp(test_in, pre_in)[0])
+                        if self.similarity in ('KS', 'ws'):
+                            sim = layer_sims[ind_inside_layer]
+                        elif len(test_in) > 20 and len(pre_in) > 20: # Chekck there are enought values for statistics
                             if self.similarity == 'kl':
                                 sim = kl(test_in, pre_in)
-                            if self.similarity =='ws':
-                                sim = 1 / ( 1e-8 + scipy.stats.wasserstein_distance(test_in, pre_in))
                             if self.similarity == 'euclidian':
                                 sim = np.sum(np.abs(test) + np.abs(pre)) / (np.sum(np.abs(test - pre)) + 1e-8)
 
                         else: # non sufficient points mark as non similarity
                             sim = -1
-                        self._plot_distribution(ind_layer=int(ind_layer),
-                                                layer_pretrained=pre_in,
-                                                layer_test=test_in,
-                                                kernel_num=ind_inside_layer,
-                                                method='gram', pvalue=sim, num_plots=num_plots,ax_sub=ax_sub,layer_name=name)
+                        if self.plot_distributions:
+                            self._plot_distribution(ind_layer=int(ind_layer),
+                                                    layer_pretrained=pre_in,
+                                                    layer_test=test_in,
+                                                    kernel_num=ind_inside_layer,
+                                                    method='gram', pvalue=sim, num_plots=num_plots,ax_sub=ax_sub,layer_name=name)
                     else:
                         sim = [-1]
                     stats_value.append(sim)
@@ -547,6 +782,45 @@ class CustomStatisticGrad:
                 self.stats_value_per_layer[name] = stats_value.copy()
             self.stats_value_per_layer[name] = stats_value.copy()
             ### Finished layer loop over kernels :
+            if self.plot_distributions:
+                if not os.path.exists(self.save_folder + '//dist/'):
+                    os.makedirs(self.save_folder + '//dist/')
+                plt.savefig(self.save_folder + '//dist/' + '//Layer_name_' +
+                            name + '.jpg', dpi=400)
+                plt.close()
+
+    def _metric_compare_sketches(self):
+        # Similarity of every kernel from the quantile sketches, all kernels of a layer at once
+        for ind_layer, name in enumerate(self.modules_name_list):
+            if ind_layer > self.max_layer:
+                break
+            if name not in self.channel_sketches['test'] or np.prod(self.activation_shapes[name][1:]) <= 20:
+                self.stats_value_per_layer[name] = [-1]
+                continue
+            sketch_test = self.channel_sketches['test'][name]
+            sketch_pre = self.channel_sketches['pre'][name]
+            stats_value = sketch_similarity(sketch_test, sketch_pre, similarity=self.similarity)
+            self.stats_value_per_layer[name] = list(stats_value)
+            if not self.plot_distributions:
+                continue
+
+            num_plots = len(stats_value)
+            fig = plt.figure(ind_layer, figsize=(20, 20))
+            ax_sub = fig.subplots(int(np.ceil(np.sqrt(num_plots))), int(np.ceil(np.sqrt(num_plots))))
+            ax_sub = ax_sub.ravel()
+            self.plot_counter = 0
+            values_test, weights_test = log_abs_filter(*sketch_test.weighted_samples())
+            values_pre, weights_pre = log_abs_filter(*sketch_pre.weighted_samples())
+            for ind_inside_layer, sim in enumerate(stats_value):
+                keep_test = weights_test[ind_inside_layer] > 0
+                keep_pre = weights_pre[ind_inside_layer] > 0
+                self._plot_distribution(ind_layer=int(ind_layer),
+                                        layer_pretrained=values_pre[ind_inside_layer][keep_pre].cpu().numpy(),
+                                        layer_test=values_test[ind_inside_layer][keep_test].cpu().numpy(),
+                                        kernel_num=ind_inside_layer,
+                                        method='gram', pvalue=sim, num_plots=num_plots, ax_sub=ax_sub, layer_name=name,
+                                        weights_pretrained=weights_pre[ind_inside_layer][keep_pre].cpu().numpy(),
+                                        weights_test=weights_test[ind_inside_layer][keep_test].cpu().numpy())
             if not os.path.exists(self.save_folder + '//dist/'):
                 os.makedirs(self.save_folder + '//dist/')
             plt.savefig(self.save_folder + '//dist/' + '//Layer_name_' +
@@ -566,7 +840,7 @@ class CustomStatisticGrad:
             if np.size(self.statistic_test[name]) > 1:  # check if has values
                 test = np.ravel(self.statistic_test[name])
                 pre  = np.ravel(self.statistic_pretrained[name])
-                if np.size(self.activations_input_pre[name][0]) > 20:
+                if np.prod(self.activation_shapes[name]) > 20:
                     ## Convert from log normal to normal distribution. (assumtion been made)
 
                     test_in = np.log(np.abs(test[np.abs(test) > 1e-7]))
@@ -643,18 +917,13 @@ class CustomStatisticGrad:
                       '  Similar distributions in activation '
                       'num: ' + str(change_inds))
                 change_activations[change_inds] *= mult_grad_value
+                # One float32 value per output channel, [C_out, 1, 1, 1] broadcasts over the kernel of the weight
+                change_activations = change_activations.astype(np.float32)
                 for weight in module.parameters():
                     new_shape = np.shape(weight)
-                    change_activations = np.reshape(
-                        change_activations,
-                        (len(change_activations), 1, 1, 1))
                     if len(new_shape) > 2:
-                        self.layers_grad_mult[name]['weights'] = {}
-                        change_activations = np.reshape(
-                            change_activations,
-                            (len(change_activations), 1, 1, 1))
-                        self.layers_grad_mult[name]['weights'] = np.tile(
-                            change_activations, (1, new_shape[1], new_shape[2], new_shape[3]))
+                        self.layers_grad_mult[name]['weights'] = np.reshape(
+                            change_activations, (len(change_activations), 1, 1, 1))
                         # Replace the chosen layer with random initialization -> for the ablation study:
                         self.ablation_mode = False
                         if self.ablation_mode:
@@ -669,9 +938,7 @@ class CustomStatisticGrad:
                             #weights_zeroing_name[name+'.weight'] = change_weights
 
                     else:
-                        self.layers_grad_mult[name]['bias'] = {}
-                        self.layers_grad_mult[name][
-                            'bias'] = change_activations
+                        self.layers_grad_mult[name]['bias'] = change_activations
         import pickle
         with open('weight_zeroing_idx.pickle', 'wb') as handle:
             pickle.dump(weights_zeroing_name, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -695,24 +962,22 @@ class CustomStatisticGrad:
                 else:
                     change_inds = []
                 if len(change_inds) > 0:
-                    self.plot_activation(name_layer=name,
-                                         indexes=change_inds,
-                                         im_batch=0, save_path=self.save_folder + '/activations/' )
+                    # A collection loaded from the activation store has no input images to plot
+                    if hasattr(self, 'activations_input_pre'):
+                        self.plot_activation(name_layer=name,
+                                             indexes=change_inds,
+                                             im_batch=0, save_path=self.save_folder + '/activations/' )
                 print('layer: ' + name +
                       '  Similar distributions in activation '
                       'num: ' + str(change_inds))
                 change_activations[change_inds] *= mult_grad_value
                 for weight in module.parameters():
                     new_shape = np.shape(weight)
+                    # One float32 scalar for the whole layer, broadcast over the weight / bias
                     if len(new_shape) > 2:
-                        self.layers_grad_mult[name]['weights'] = {}
-                        self.layers_grad_mult[name]['weights'] = mult_grad_value * np.ones_like(weight.cpu()
-                                                                                                .detach().numpy())
+                        self.layers_grad_mult[name]['weights'] = np.full((), mult_grad_value, dtype=np.float32)
                     else:
-                        self.layers_grad_mult[name]['bias'] = {}
-                        self.layers_grad_mult[name][
-                            'bias'] = mult_grad_value * np.ones_like(weight.cpu()
-                                                                     .detach().numpy())
+                        self.layers_grad_mult[name]['bias'] = np.full((), mult_grad_value, dtype=np.float32)
 
     def _initialize_parameters(self):
         self.outputs_list = defaultdict(int)
@@ -729,6 +994,19 @@ class CustomStatisticGrad:
         self.mean_var_tested = []
         self.mean_var_pretrained_data = []
         self.stats_value = []
+        self.channel_stats = {stream: defaultdict(ChannelStatistics) for stream in STREAMS}
+        # Same seed for every stream so the pretrained and new dataset samples are paired
+        self.channel_reservoirs = {stream: defaultdict(partial(ChannelReservoir, self.reservoir_size, self.seed))
+                                   for stream in STREAMS}
+        self.channel_sketches = {stream: defaultdict(partial(ChannelQuantileSketch, self.sketch_size, self.seed))
+                                 for stream in STREAMS}
+        self.activation_shapes = {}
+        self._stream = STREAMS[0]
+        self.stored_stages = []
+        self.engine = None
+        self.analysis_network = self.network
+        self._stage_exchange = None
+        self._raw_first_batch = True
 
     @ staticmethod
     def calculate_kl_divergence(vector1, vector2):
@@ -742,15 +1020,117 @@ class CustomStatisticGrad:
     # Calculate the KL divergence between the two distributions
         return kl_divergence
 
-    def run(self, mode='per_layer'):
+    def _run_collection(self, batches_num=10, mode='normal', collection='layer_wise'):
+        # Statistics pass over the loaders, on the analysis replica when the inference engine is used
+        if self.inference_engine:
+            # The hooks look at single conv outputs, folding the BatchNorm into the conv would change them
+            self.engine = AnalysisEngine(self.network, fold_batch_norm=collection != 'hooks',
+                                         compile_stages=self.compile_stages, channels_last=self.channels_last)
+            self.analysis_network = self.engine.network
+            analysis_context = self.engine.context()
+        else:
+            self.engine = None
+            self.analysis_network = self.network
+            analysis_context = contextlib.nullcontext()
+        with analysis_context, self._precision_context():
+            if collection == 'hooks':
+                self._calc_hooked_layers_outputs(batches_num=batches_num, mode=mode)
+            else:
+                self._calc_layers_outputs(batches_num=batches_num, mode=mode)
+
+    def _precision_context(self):
+        # Autocast of the forwards and the encoder for the reduced precision policies
+        if self.precision == 'float32':
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=PRECISIONS[self.precision])
+
+    def _collect_scores(self, mode='per_layer', collection='layer_wise', use_store=True):
+        # Statistics pass (or the stored collection) followed by the metric phase, fills stats_value_per_layer
         self._initialize_parameters()
         self._prepare_input_tensor()
-        self._calc_layers_outputs(batches_num=self.num_batches,mode=mode)
+        store = self.activation_store if use_store else None
+        store_config = self._store_config(collection)
+        if store is not None and store.matches(store_config):
+            self._load_stored_outputs(mode=mode, collection=collection)
+        else:
+            if store is not None and (self.num_workers > 1 or self.process_group is not None):
+                print('Activation store is not written by the parallel collection')
+                store = None
+            if store is not None:
+                store.reset()
+            # The collection writes to self.activation_store, which is None when the store is bypassed
+            activation_store = self.activation_store
+            self.activation_store = store
+            try:
+                if self.num_workers > 1:
+                    parallel_collect(self, mode=mode, collection=collection)
+                elif self.process_group is not None:
+                    distributed_collect(self, mode=mode, collection=collection)
+                else:
+                    self._run_collection(batches_num=self.num_batches, mode=mode, collection=collection)
+            finally:
+                self.activation_store = activation_store
+            self._summarize_channel_stats()
+            if store is not None:
+                store.close(store_config, modules=self.modules_name_list, stages=self.stored_stages)
+        if not is_main_rank(self.process_group):
+            # Only rank 0 runs the metric phase and the gradient search
+            return
         if mode == 'per_layer':
             self._metric_compare_full_layer()
-            self._require_grad_search_layer(percent=self.threshold_percent)
-        else:
-            #self._metric_compare()
-            self._require_grad_search(percent=self.threshold_percent)
+        elif collection == 'hooks':
+            if len(self.channel_sketches['test']) > 0:
+                self._metric_compare_sketches()
+            else:
+                self._metric_compare()
+
+    def precision_report(self, mode='normal', collection='layer_wise'):
+        '''
+        Runs the statistics pass in float32 and with the precision policy and reports, per layer, the drift of the
+        per kernel similarity scores: mean / max relative difference and the share of kernels whose selection by the
+        percent threshold stays the same. The activation store is not used.
+        Both passes have to see the same batches, so the loaders may not shuffle.
+        '''
+        for loader in (self.pretrained_data_set, self.input_test, self.pretrained_data_set2):
+            if loader is not None and not is_sequential(loader):
+                raise ValueError('The precision report compares two passes over the same batches, got a loader with ' +
+                                 loader.sampler.__class__.__name__ + ', use shuffle=False')
+        precision = self.precision
+        scores = {}
+        try:
+            for run_precision in ('float32', precision):
+                self.precision = run_precision
+                self._collect_scores(mode=mode, collection=collection, use_store=False)
+                scores[run_precision] = {name: np.hstack(values).astype(float)
+                                         for name, values in self.stats_value_per_layer.items()}
+        finally:
+            self.precision = precision
+        report = {}
+        for name, reference in scores['float32'].items():
+            reduced = scores[precision][name]
+            valid = (reference != -1) & np.isfinite(reference) & np.isfinite(reduced)
+            drift = np.abs(reduced[valid] - reference[valid]) / (np.abs(reference[valid]) + 1e-12)
+            selection_reference = reference > np.percentile(reference, self.threshold_percent)
+            selection_reduced = reduced > np.percentile(reduced, self.threshold_percent)
+            report[name] = {'mean_relative_drift': float(np.mean(drift)) if len(drift) > 0 else 0.0,
+                            'max_relative_drift': float(np.max(drift)) if len(drift) > 0 else 0.0,
+                            'selection_agreement': float(np.mean(selection_reference == selection_reduced))}
+            print('layer: ' + name + '  ' + precision + ' vs float32 similarity drift mean: ' +
+                  str(np.round(report[name]['mean_relative_drift'], 4)) + ' max: ' +
+                  str(np.round(report[name]['max_relative_drift'], 4)) + ' selection agreement: ' +
+                  str(np.round(report[name]['selection_agreement'], 3)))
+        return report
+
+    def run(self, mode='per_layer', collection='layer_wise'):
+        # collection: 'layer_wise' -> layer by layer propagation with the encoder based similarity,
+        #             'hooks' -> forward hooks over the full network.
+        self._collect_scores(mode=mode, collection=collection)
+        if is_main_rank(self.process_group):
+            if mode == 'per_layer':
+                self._require_grad_search_layer(percent=self.threshold_percent)
+            else:
+                self._require_grad_search(percent=self.threshold_percent)
+        if self.process_group is not None:
+            broadcast_grad_masks(self)
 
 
@@ -1,6 +1,7 @@
 import numpy as np
 from torchvision import transforms
 import torch
+import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 from torchvision import transforms, datasets
 
@@ -40,6 +41,39 @@ class DeepAutoencoder(torch.nn.Module):
         return decoded
 
 
+class FoldedEncoder(torch.nn.Module):
+    '''
+    Applies the encoder of a DeepAutoencoder to feature maps [#maps, H, W] at their native resolution.
+    The nearest upsampling to 64x64 in front of the encoder is a fixed linear map, so it is folded into the first
+    Linear layer: the weights of all the upsampled pixels which copy the same source pixel are summed. The folded
+    weights are cached per resolution. Maps with H*W >= 64*64 are upsampled and encoded as before.
+    '''
+    def __init__(self, encoder: torch.nn.Sequential, size: tuple=(64, 64)):
+        super().__init__()
+        self.encoder = encoder
+        self.size = size
+        self._folded_weights = {}
+
+    def folded_weight(self, height, width):
+        first = self.encoder[0]
+        key = (height, width, first.weight.device, first.weight.dtype)
+        if key not in self._folded_weights:
+            # Source pixel of every upsampled pixel, computed by upsampling an image of pixel indices
+            indices = torch.arange(height * width, dtype=torch.float32, device=first.weight.device)
+            indices = F.interpolate(indices.view(1, 1, height, width), size=self.size, mode='nearest').view(-1).long()
+            folded = first.weight.new_zeros((first.out_features, height * width))
+            self._folded_weights[key] = folded.index_add_(1, indices, first.weight.detach())
+        return self._folded_weights[key]
+
+    def forward(self, maps):
+        height, width = maps.shape[-2:]
+        if height * width >= self.size[0] * self.size[1]:
+            resized = F.interpolate(maps.reshape(-1, 1, height, width), size=self.size, mode='nearest')
+            return self.encoder(resized.view(-1, self.size[0] * self.size[1]))
+        hidden = F.linear(maps.reshape(-1, height * width), self.folded_weight(height, width), self.encoder[0].bias)
+        return self.encoder[1:](hidden)
+
+
 # Instantiating the model and hyperparameters
 
 if __name__ == '__main__':
@@ -5,6 +5,8 @@ class PriorPreprocess:
         self.__dict__.update(kwargs)
         self.method = method
         self.shape_act = shape_act
+        if method == 'fft' and shape_act is not None:
+            self.fft_size = int(self.shape_act[2]/2)
 
     def run_prior_transformation(self, layer):
         if self.method == 'fft':
@@ -14,6 +16,13 @@ class PriorPreprocess:
         if self.method == 'linear':
             return np.ravel(layer)
 
+    def transform_batches(self, channel, batch_size):
+        # Transforms a stored channel [#samples, ...] batch by batch and concatenates the results the same way the
+        # statistics collection does. Works on memory-mapped channels, only one batch is read at a time.
+        values = [self.run_prior_transformation(channel[start:start + batch_size])
+                  for start in range(0, len(channel), batch_size)]
+        return np.concatenate([values[0]] + [np.clip(np.abs(value), -2e6, 2e6) for value in values[1:]])
+
     def initialize_list(self):
         if self.method == 'fft':
             self.fft_size = int(self.shape_act[2]/2)
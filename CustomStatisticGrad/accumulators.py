@@ -0,0 +1,198 @@
+import numpy as np
+import torch
+
+
+class ChannelStatistics:
+    '''
+    Streaming per-channel statistics of activation maps.
+    The state lives on the device of the activations and is updated batch by batch, so the raw activations never
+    have to be copied to the host. Only the small per-channel summaries are converted to NumPy at the end.
+
+    Collected per channel:
+    count, mean and M2 (running moments, merged with Chan's parallel update),
+    zeros -> number of values with |x| <= zero_threshold,
+    min / max,
+    hist -> fixed-bin histogram of log(|x|) over log_range (values outside the range go to the edge bins,
+            zeros are not histogrammed).
+    '''
+    def __init__(self, num_bins: int=100, log_range: tuple=(-16.0, 8.0), zero_threshold: float=1e-8):
+        self.num_bins = num_bins
+        self.log_range = log_range
+        self.zero_threshold = zero_threshold
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.zeros = None
+        self.min = None
+        self.max = None
+        self.hist = None
+
+    def _allocate(self, num_channels, device):
+        self.mean = torch.zeros(num_channels, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(num_channels, dtype=torch.float64, device=device)
+        self.zeros = torch.zeros(num_channels, dtype=torch.int64, device=device)
+        self.min = torch.full((num_channels,), np.inf, dtype=torch.float64, device=device)
+        self.max = torch.full((num_channels,), -np.inf, dtype=torch.float64, device=device)
+        self.hist = torch.zeros((num_channels, self.num_bins), dtype=torch.int64, device=device)
+
+    def update(self, activations: torch.Tensor):
+        '''
+        Adds a batch of activations [#BatchSize, #channels, ...] to the statistics.
+        Returns the number of near zero values per channel in this batch.
+        '''
+        values = activations.detach()
+        num_channels = values.shape[1]
+        # -> [#channels, #BatchSize * #activation size]
+        values = values.transpose(0, 1).reshape(num_channels, -1).float()
+        if self.mean is None:
+            self._allocate(num_channels, values.device)
+        num_values = values.shape[1]
+        if num_values == 0:
+            return torch.zeros_like(self.zeros)
+
+        batch_var, batch_mean = torch.var_mean(values, dim=1, correction=0)
+        batch_mean = batch_mean.double()
+        batch_m2 = batch_var.double() * num_values
+        total = self.count + num_values
+        delta = batch_mean - self.mean
+        self.mean += delta * (num_values / total)
+        self.m2 += batch_m2 + delta ** 2 * (self.count * num_values / total)
+        self.count = total
+
+        self.min = torch.minimum(self.min, values.amin(dim=1).double())
+        self.max = torch.maximum(self.max, values.amax(dim=1).double())
+
+        abs_values = values.abs()
+        non_zero = abs_values > self.zero_threshold
+        batch_zeros = num_values - non_zero.sum(dim=1)
+        self.zeros += batch_zeros
+
+        low, high = self.log_range
+        bins = ((torch.log(abs_values.clamp_min(self.zero_threshold)) - low) *
+                (self.num_bins / (high - low))).long().clamp_(0, self.num_bins - 1)
+        # Linear bin index per channel so all channels are counted with a single bincount
+        bins += torch.arange(num_channels, device=bins.device).unsqueeze(1) * self.num_bins
+        self.hist += torch.bincount(bins[non_zero], minlength=num_channels * self.num_bins).view(
+            num_channels, self.num_bins)
+        return batch_zeros
+
+    def merge(self, other: 'ChannelStatistics'):
+        '''
+        Combines the statistics of another accumulator (other batches/workers) into this one.
+        '''
+        if other.mean is None or other.count == 0:
+            return self
+        if self.mean is None:
+            self._allocate(len(other.mean), other.mean.device)
+        other_mean = other.mean.to(self.mean.device)
+        total = self.count + other.count
+        delta = other_mean - self.mean
+        self.mean += delta * (other.count / total)
+        self.m2 += other.m2.to(self.m2.device) + delta ** 2 * (self.count * other.count / total)
+        self.count = total
+        self.zeros += other.zeros.to(self.zeros.device)
+        self.min = torch.minimum(self.min, other.min.to(self.min.device))
+        self.max = torch.maximum(self.max, other.max.to(self.max.device))
+        self.hist += other.hist.to(self.hist.device)
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+    @property
+    def std(self):
+        return torch.sqrt(self.variance)
+
+    def hist_edges(self):
+        low, high = self.log_range
+        return np.linspace(low, high, self.num_bins + 1)
+
+    def summary(self):
+        '''
+        Small NumPy summary of the collected statistics.
+        '''
+        if self.mean is None:
+            return {}
+        return {'count': self.count,
+                'mean': self.mean.cpu().numpy(),
+                'std': self.std.cpu().numpy(),
+                'zeros': self.zeros.cpu().numpy(),
+                'min': self.min.cpu().numpy(),
+                'max': self.max.cpu().numpy(),
+                'log_hist': self.hist.cpu().numpy(),
+                'log_hist_edges': self.hist_edges()}
+
+
+class ChannelReservoir:
+    '''
+    Fixed size uniform sample of the values of every channel, filled while the batches stream in (reservoir sampling,
+    algorithm R). Memory per channel is capped by size no matter how many batches are analysed.
+    All the channels of a layer see the same number of values, so a single set of slot decisions drawn from the seeded
+    generator is shared by all of them. Reservoirs with the same seed that see the same number of values (the
+    pretrained and the new dataset) keep the same positions, so their samples stay paired.
+    '''
+    def __init__(self, size: int=50000, seed: int=0):
+        self.size = size
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.seen = 0
+        self.values = None
+
+    def update(self, activations: torch.Tensor):
+        values = activations.detach()
+        # -> [#channels, #BatchSize * #activation size]
+        values = values.transpose(0, 1).reshape(values.shape[1], -1)
+        num_values = values.shape[1]
+        if self.values is None:
+            self.values = values.new_empty((values.shape[0], self.size))
+        # Empty slots are filled in order
+        num_fill = min(max(self.size - self.seen, 0), num_values)
+        self.values[:, self.seen:self.seen + num_fill] = values[:, :num_fill]
+        if num_values > num_fill:
+            positions = np.arange(self.seen + num_fill, self.seen + num_values)
+            slots = self.rng.integers(0, positions + 1)
+            keep = slots < self.size
+            slots = slots[keep][::-1]
+            sources = np.arange(num_fill, num_values)[keep][::-1]
+            # A slot chosen more than once keeps the latest value, as in the sequential algorithm
+            slots, last = np.unique(slots, return_index=True)
+            sources = sources[last]
+            self.values[:, torch.as_tensor(slots, device=values.device)] = \
+                values[:, torch.as_tensor(sources, device=values.device)]
+        self.seen += num_values
+
+    def merge(self, other: 'ChannelReservoir'):
+        '''
+        Combines with the reservoir of other batches/workers into a uniform sample of the union of their values.
+        '''
+        if other.values is None or other.seen == 0:
+            return self
+        if self.values is None or self.seen == 0:
+            self.values = other.values.clone()
+            self.seen = other.seen
+            return self
+        samples = self.samples()
+        other_samples = other.samples().to(samples.device)
+        total = self.seen + other.seen
+        if total <= self.size:
+            merged = torch.cat([samples, other_samples], dim=1)
+        else:
+            # Number of kept values from each side follows the share of values each side has seen
+            num_self = int(self.rng.hypergeometric(self.seen, other.seen, self.size))
+            num_self = min(num_self, samples.shape[1])
+            num_other = min(self.size - num_self, other_samples.shape[1])
+            merged = torch.cat([samples[:, torch.as_tensor(self.rng.permutation(samples.shape[1])[:num_self],
+                                                           device=samples.device)],
+                                other_samples[:, torch.as_tensor(self.rng.permutation(other_samples.shape[1])[:num_other],
+                                                                 device=samples.device)]], dim=1)
+        self.values = samples.new_empty((samples.shape[0], self.size))
+        self.values[:, :merged.shape[1]] = merged
+        self.seen = total
+        return self
+
+    def samples(self):
+        '''
+        The sampled values [#channels, min(seen, size)].
+        '''
+        return self.values[:, :min(self.seen, self.size)]
@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class ActivationStore:
+    '''
+    On-disk store of the activations collected by CustomStatisticGrad, so the analysis can be repeated with another
+    similarity / process_method / percent without running the network again.
+
+    Every (kind, layer, stream) is one .npy file laid out channel first [#channels, #samples, ...], written once
+    during the statistics pass and memory-mapped (read only) on later runs. kind is 'activations' for the layer
+    outputs or 'embeddings' for the encoder outputs. Per channel summaries are kept next to them as .npz files.
+    '''
+    def __init__(self, root: str, dtype: str='float32'):
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self._files = {}
+        self._counts = {}
+        self.metadata = self._read_metadata()
+
+    def _metadata_path(self):
+        return os.path.join(self.root, 'metadata.json')
+
+    def _read_metadata(self):
+        if not os.path.exists(self._metadata_path()):
+            return {}
+        with open(self._metadata_path(), 'r') as f:
+            return json.load(f)
+
+    def _path(self, kind, layer, stream, extension='.npy'):
+        return os.path.join(self.root, kind, layer, stream + extension)
+
+    @property
+    def complete(self):
+        return self.metadata.get('complete', False)
+
+    def matches(self, config: dict):
+        # The store can only replace the network pass if it was written with the same collection settings
+        return self.complete and self.metadata.get('config') == config
+
+    def reset(self):
+        # Invalidates the stored collection before it is overwritten
+        if os.path.exists(self._metadata_path()):
+            os.remove(self._metadata_path())
+        self.metadata = {}
+        self._files = {}
+        self._counts = {}
+
+    def append(self, kind: str, layer: str, stream: str, values: torch.Tensor, capacity: int):
+        '''
+        Appends a batch [#BatchSize, #channels, ...]. The file is allocated for capacity samples on the first append.
+        '''
+        key = (kind, layer, stream)
+        values = values.detach()
+        if key not in self._files:
+            path = self._path(kind, layer, stream)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            shape = (values.shape[1], capacity) + tuple(values.shape[2:])
+            self._files[key] = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+            self._counts[key] = 0
+        memmap = self._files[key]
+        start = self._counts[key]
+        if start + len(values) > memmap.shape[1]:
+            raise ValueError('Activation store capacity of ' + str(memmap.shape[1]) + ' samples exceeded for ' +
+                             '/'.join(key))
+        memmap[:, start:start + len(values)] = values.transpose(0, 1).float().cpu().numpy()
+        self._counts[key] = start + len(values)
+
+    def write(self, kind: str, layer: str, stream: str, values: torch.Tensor):
+        self.append(kind, layer, stream, values, capacity=len(values))
+
+    def write_summary(self, layer: str, stream: str, summary: dict):
+        path = self._path('summaries', layer, stream, extension='.npz')
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        np.savez(path, **summary)
+
+    def close(self, config: dict, **metadata):
+        '''
+        Flushes the written files and marks the store as complete for the given collection settings.
+        '''
+        for memmap in self._files.values():
+            memmap.flush()
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.metadata = dict(metadata, config=config, complete=True,
+                             counts={'/'.join(key): count for key, count in self._counts.items()})
+        with open(self._metadata_path(), 'w') as f:
+            json.dump(self.metadata, f)
+        self._files = {}
+        self._counts = {}
+
+    def contains(self, kind: str, layer: str, stream: str):
+        return '/'.join((kind, layer, stream)) in self.metadata.get('counts', {})
+
+    def read(self, kind: str, layer: str, stream: str):
+        '''
+        Memory-mapped view [#channels, #samples, ...] of a stored layer.
+        '''
+        memmap = np.load(self._path(kind, layer, stream), mmap_mode='r')
+        return memmap[:, :self.metadata['counts']['/'.join((kind, layer, stream))]]
+
+    def summary(self, layer: str, stream: str):
+        with np.load(self._path('summaries', layer, stream, extension='.npz')) as summary:
+            return {key: summary[key] for key in summary.files}
+
+
+class LazyChannels:
+    '''
+    Sequence over the channels of a stored layer which applies transform to a channel only when it is accessed.
+    '''
+    def __init__(self, channels, transform):
+        self.channels = channels
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, index):
+        return self.transform(self.channels[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
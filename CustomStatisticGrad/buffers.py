@@ -0,0 +1,52 @@
+import numpy as np
+import torch
+
+
+class GrowableBuffer:
+    '''
+    Preallocated tensor buffer that batches are appended to along the first dimension.
+    Replaces accumulating with torch.cat([old, new]) which copies the whole history on every append.
+    The storage is allocated on the first append (shape, dtype and device are taken from it unless given) and grows
+    geometrically when the capacity is exceeded. view() returns the filled part without copying.
+    '''
+    def __init__(self, capacity: int=0, growth: float=2.0, dtype: torch.dtype=None, device=None):
+        self.capacity = capacity
+        self.growth = growth
+        self.dtype = dtype
+        self.device = device
+        self._data = None
+        self._size = 0
+
+    def append(self, values: torch.Tensor):
+        values = values.detach()
+        num_values = len(values)
+        if self._data is None:
+            dtype = values.dtype if self.dtype is None else self.dtype
+            device = values.device if self.device is None else self.device
+            self._data = torch.empty((max(self.capacity, num_values),) + tuple(values.shape[1:]),
+                                     dtype=dtype, device=device)
+        elif tuple(values.shape[1:]) != tuple(self._data.shape[1:]):
+            raise ValueError('Appended shape ' + str(tuple(values.shape[1:])) + ' does not match the buffer shape ' +
+                             str(tuple(self._data.shape[1:])))
+        if self._size + num_values > len(self._data):
+            self._grow(self._size + num_values)
+        self._data[self._size:self._size + num_values].copy_(values)
+        self._size += num_values
+        return self
+
+    def _grow(self, required_size):
+        new_capacity = max(required_size, int(np.ceil(len(self._data) * self.growth)))
+        data = self._data.new_empty((new_capacity,) + tuple(self._data.shape[1:]))
+        data[:self._size].copy_(self._data[:self._size])
+        self._data = data
+
+    def view(self):
+        '''
+        The appended values, as a view of the buffer storage.
+        '''
+        if self._data is None:
+            return torch.empty(0)
+        return self._data[:self._size]
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,103 @@
+from collections import defaultdict
+
+import torch
+import torch.distributed as dist
+
+from CustomStatisticGrad.accumulators import ChannelStatistics
+from CustomStatisticGrad.parallel import STREAMS, shard_batches, shard_loader, available_batches, _worker_state, \
+    _merge_hooked_states
+from CustomStatisticGrad.statistic_metrics import histogramdd_range, histogramdd_counts, histogram_kl
+
+
+class DistributedStageExchange:
+    '''
+    Stage of the layer-wise pass over a torch.distributed process group: every rank holds the embeddings of its own
+    samples. The channel statistics are all-gathered and merged, the embedding ranges and histograms all-reduced,
+    so every rank computes the same similarity and compensation moments as a single process over all the samples.
+    '''
+    def __init__(self, group):
+        self.group = group
+
+    def stage_similarity(self, analysis, name, embeddings):
+        # [#samples, #channels, #dims] -> [#channels, #samples, #dims]
+        embeddings = [stream_embeddings.transpose(0, 1).double().cpu() for stream_embeddings in embeddings]
+        gathered = [None] * dist.get_world_size(self.group)
+        dist.all_gather_object(gathered, {stream: analysis.channel_stats[stream][name] for stream in STREAMS},
+                               group=self.group)
+        for stream in STREAMS:
+            merged = ChannelStatistics()
+            for rank_stats in gathered:
+                merged.merge(rank_stats[stream])
+            analysis.channel_stats[stream][name] = merged
+
+        lower = embeddings[0].amin(dim=1)
+        upper = embeddings[0].amax(dim=1)
+        dist.all_reduce(lower, op=dist.ReduceOp.MIN, group=self.group)
+        dist.all_reduce(upper, op=dist.ReduceOp.MAX, group=self.group)
+        lower, upper = histogramdd_range(lower, upper)
+        histograms = [histogramdd_counts(stream_embeddings, lower, upper) for stream_embeddings in embeddings]
+        for histogram in histograms:
+            dist.all_reduce(histogram, op=dist.ReduceOp.SUM, group=self.group)
+        kl_test = histogram_kl(histograms[0], histograms[1])
+        kl_pre2 = histogram_kl(histograms[0], histograms[2])
+        analysis._kernel_moments(name)
+        return list((1 / (kl_test * kl_pre2)).numpy())
+
+
+def is_main_rank(group):
+    return group is None or dist.get_rank(group) == 0
+
+
+def distributed_collect(analysis, mode='normal', collection='layer_wise'):
+    '''
+    Runs the statistics pass of a CustomStatisticGrad on every rank of analysis.process_group (e.g. gloo on CPU).
+    Every rank analyses a disjoint contiguous block of the batches of the loaders. The layer-wise pass exchanges its
+    statistics stage by stage (DistributedStageExchange); the hook collection all-gathers the rank accumulators and
+    per kernel values at the end and merges them in rank order. Afterwards every rank holds the statistics of all the
+    batches.
+    '''
+    group = analysis.process_group
+    world_size = dist.get_world_size(group)
+    num_batches = available_batches(analysis)
+    if num_batches < world_size:
+        raise ValueError('Every rank needs at least one batch, got ' + str(num_batches) + ' batches for ' +
+                         str(world_size) + ' ranks')
+    batches = shard_batches(num_batches, world_size)[dist.get_rank(group)]
+    loaders = analysis.pretrained_data_set, analysis.input_test, analysis.pretrained_data_set2
+    analysis.pretrained_data_set = shard_loader(analysis.pretrained_data_set, batches)
+    analysis.input_test = shard_loader(analysis.input_test, batches)
+    analysis.pretrained_data_set2 = shard_loader(analysis.pretrained_data_set2, batches)
+    analysis._prepare_input_tensor()
+    # Only the block holding the first batch keeps its first batch untransformed, as the serial collection does
+    analysis._raw_first_batch = batches[0] == 0
+    if collection != 'hooks':
+        analysis._stage_exchange = DistributedStageExchange(group)
+    try:
+        analysis._run_collection(batches_num=len(batches) - 1, mode=mode, collection=collection)
+    finally:
+        analysis.pretrained_data_set, analysis.input_test, analysis.pretrained_data_set2 = loaders
+        analysis._stage_exchange = None
+        analysis._raw_first_batch = True
+    if collection == 'hooks':
+        states = [None] * world_size
+        dist.all_gather_object(states, _worker_state(analysis, mode, collection), group=group)
+        for key in ('channel_stats', 'channel_reservoirs', 'channel_sketches'):
+            setattr(analysis, key, {stream: defaultdict(getattr(analysis, key)[stream].default_factory)
+                                    for stream in STREAMS})
+        analysis.stats_test = defaultdict(int)
+        analysis.pre_trained_outputs = defaultdict(int)
+        analysis.statistic_test = defaultdict(list)
+        analysis.statistic_pretrained = defaultdict(list)
+        _merge_hooked_states(analysis, states, mode)
+        for state in states:
+            analysis.activation_shapes.update(state['activation_shapes'])
+
+
+def broadcast_grad_masks(analysis):
+    '''
+    Sends the layers_grad_mult masks found on rank 0 of analysis.process_group to all the ranks.
+    '''
+    group = analysis.process_group
+    masks = [dict(analysis.layers_grad_mult) if is_main_rank(group) else None]
+    dist.broadcast_object_list(masks, src=dist.get_global_rank(group, 0), group=group)
+    analysis.layers_grad_mult = defaultdict(dict, masks[0])
@@ -0,0 +1,173 @@
+from functools import partial
+
+import numpy as np
+import torch
+
+
+def _masked_conv_layers(net, layers_grad_mult, modules_name_list):
+    # The layers update_grads scales: convolutions with a found mask
+    modules = dict(net.named_modules())
+    for name in modules_name_list:
+        module = modules[name]
+        if 'weight' in module._parameters and 'Conv' in module._get_name() and len(layers_grad_mult.get(name, {})) > 0:
+            # Hard frozen layers (hard_freeze) get no gradients at all
+            if module.weight.requires_grad:
+                yield name, module
+
+
+def hard_freeze(net, layers_grad_mult, threshold=1e-6):
+    '''
+    Turns the layers whose masks are all <= threshold (the per_layer mode multiplier) into requires_grad=False
+    parameters, so autograd computes no weight gradients for them and stops backpropagating below the first
+    parameter which still trains. Returns the name of that parameter (None when everything is frozen).
+    Weights and biases are both frozen, which matches the normal mode only (freeze_except_bias trains the biases).
+    '''
+    modules = dict(net.named_modules())
+    for name, masks in layers_grad_mult.items():
+        if name in modules and len(masks) > 0 and max(float(np.max(mask)) for mask in masks.values()) <= threshold:
+            for parameter in modules[name].parameters():
+                parameter.requires_grad_(False)
+    for name, parameter in net.named_parameters():
+        if parameter.requires_grad:
+            return name
+    return None
+
+
+class GradientMasks:
+    '''
+    layers_grad_mult of a CustomStatisticGrad compiled once into tensors on the device of the parameters, applied by
+    tensor hooks on the masked weights / biases while the gradients are computed (no per step work in the training
+    loop). Same scaling as CustomStatisticGrad.update_grads:
+    mode -> 'normal': the weight / bias gradients are multiplied by their masks,
+            'freeze_except_bias': the weight gradient of every masked layer is multiplied by
+            min(1e-3, 2**epoch * min(mask)), the bias is trained freely.
+    until_epoch -> the masks apply for the epochs < until_epoch (set_epoch), None applies them always.
+    '''
+    def __init__(self, net, layers_grad_mult, modules_name_list, mode='normal', until_epoch=None):
+        self.mode = mode
+        self.until_epoch = until_epoch
+        self.enabled = True
+        self.masks = {}
+        self.mask_minimum = {}
+        self.handles = []
+        for name, module in _masked_conv_layers(net, layers_grad_mult, modules_name_list):
+            weight = module.weight
+            if mode == 'freeze_except_bias':
+                # One scalar per layer, refilled in place by set_epoch
+                self.mask_minimum[name] = float(np.min(layers_grad_mult[name]['weights']))
+                self._register(name + '.weight', weight, torch.ones((), dtype=weight.dtype, device=weight.device))
+            else:
+                self._register(name + '.weight', weight, torch.as_tensor(np.asarray(layers_grad_mult[name]['weights']),
+                                                                         dtype=weight.dtype, device=weight.device))
+                if module.bias is not None and 'bias' in layers_grad_mult[name]:
+                    self._register(name + '.bias', module.bias,
+                                   torch.as_tensor(np.squeeze(layers_grad_mult[name]['bias']),
+                                                   dtype=module.bias.dtype, device=module.bias.device).reshape(-1))
+        self.set_epoch(0)
+
+    def _register(self, name, parameter, mask):
+        self.masks[name] = mask
+        self.handles.append(parameter.register_hook(partial(self._scale, mask)))
+
+    def _scale(self, mask, grad):
+        if not self.enabled:
+            return grad
+        return grad * mask
+
+    def set_epoch(self, epoch):
+        self.enabled = self.until_epoch is None or epoch < self.until_epoch
+        if self.enabled and self.mode == 'freeze_except_bias':
+            for name, minimum in self.mask_minimum.items():
+                self.masks[name + '.weight'].fill_(float(np.min([1e-3, (2 ** epoch) * minimum])))
+
+    def detach(self):
+        # Removes the hooks, the gradients are not scaled anymore
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+class MaskedRows:
+    '''
+    Output channels (rows, dim 0) of a masked parameter: the trainable rows (mask 1) are a separate dense parameter
+    stepped by the base optimizer, the frozen rows keep their multiplier as scale.
+    '''
+    def __init__(self, parameter, mask):
+        self.parameter = parameter
+        mask = torch.as_tensor(np.asarray(mask), dtype=parameter.dtype, device=parameter.device).reshape(-1)
+        if mask.numel() == 1:
+            mask = mask.expand(parameter.shape[0])
+        trainable = mask >= 1
+        self.trainable_index = torch.nonzero(trainable).flatten()
+        self.frozen_index = torch.nonzero(~trainable).flatten()
+        self.frozen_scale = mask[self.frozen_index].reshape((-1,) + (1,) * (parameter.dim() - 1))
+        self.trainable = None
+        if len(self.trainable_index) > 0:
+            self.trainable = torch.nn.Parameter(parameter.detach().index_select(0, self.trainable_index).clone())
+
+
+class MaskedOptimizer(torch.optim.Optimizer):
+    '''
+    Optimizer step which uses the channel masks of a CustomStatisticGrad (layers_grad_mult) instead of scaling the
+    gradients: the base optimizer (optimizer_class(params, **kwargs)) holds state and steps only the unmasked
+    parameters and the trainable output channels of the masked convolutions. Optimizer memory and step time follow
+    the trainable fraction.
+    The frozen output channels (multiplier < 1) have no optimizer state, they are updated by plain SGD with
+    lr * their multiplier, lr of the first param group. With an adaptive base optimizer (Adam) this differs from
+    scaling their gradients: Adam normalizes the gradient scale away, here the multiplier scales the step itself.
+    param_groups, state and state_dict are the ones of the base optimizer, so lr schedulers and checkpoints work on
+    the MaskedOptimizer. Replaces the 'normal' mode of GradientMasks / update_grads, use the optimizer with unscaled
+    gradients.
+    '''
+    def __init__(self, net, layers_grad_mult, modules_name_list, optimizer_class, **kwargs):
+        self.masked_rows = []
+        for name, module in _masked_conv_layers(net, layers_grad_mult, modules_name_list):
+            for kind, parameter in (('weights', module.weight), ('bias', module.bias)):
+                if parameter is not None and kind in layers_grad_mult[name]:
+                    self.masked_rows.append(MaskedRows(parameter, layers_grad_mult[name][kind]))
+        masked = set(rows.parameter for rows in self.masked_rows)
+        params = [parameter for parameter in net.parameters() if parameter.requires_grad and parameter not in masked]
+        params += [rows.trainable for rows in self.masked_rows if rows.trainable is not None]
+        self.optimizer = optimizer_class(params, **kwargs)
+        super().__init__(params, self.optimizer.defaults)
+        self._share_base_state()
+
+    def _share_base_state(self):
+        # The same param_groups / state objects as the base optimizer, lr changes reach its step
+        self.defaults = self.optimizer.defaults
+        self.param_groups = self.optimizer.param_groups
+        self.state = self.optimizer.state
+
+    def zero_grad(self, set_to_none: bool=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+        for rows in self.masked_rows:
+            rows.parameter.grad = None
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        lr = self.param_groups[0]['lr']
+        for rows in self.masked_rows:
+            grad = rows.parameter.grad
+            if grad is None:
+                continue
+            if rows.trainable is not None:
+                rows.trainable.grad = grad.index_select(0, rows.trainable_index)
+            if len(rows.frozen_index) > 0:
+                rows.parameter.index_add_(0, rows.frozen_index,
+                                          grad.index_select(0, rows.frozen_index) * rows.frozen_scale, alpha=-lr)
+        self.optimizer.step()
+        for rows in self.masked_rows:
+            if rows.trainable is not None:
+                rows.parameter.index_copy_(0, rows.trainable_index, rows.trainable)
+        return loss
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict)
+        self._share_base_state()
@@ -0,0 +1,80 @@
+import copy
+
+import torch
+
+
+def fuse_conv_bn(conv: torch.nn.Conv2d, bn: torch.nn.BatchNorm2d):
+    '''
+    Conv2d equal to bn(conv(x)) with the running statistics of bn (eval mode).
+    '''
+    fused = copy.deepcopy(conv)
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else 1 / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    shift = bn.bias if bn.affine else torch.zeros_like(bn.running_mean)
+    fused.weight = torch.nn.Parameter((conv.weight * scale.view(-1, 1, 1, 1)).detach(), requires_grad=False)
+    fused.bias = torch.nn.Parameter(((bias - bn.running_mean) * scale + shift).detach(), requires_grad=False)
+    return fused
+
+
+def fold_batch_norms(module: torch.nn.Module):
+    '''
+    Folds every BatchNorm2d that directly follows a Conv2d inside a Sequential container into the convolution, the
+    BatchNorm is replaced by an Identity so the module names stay the same. Returns the number of folded pairs.
+    Only pairs inside a Sequential are known to be consecutive, modules which call their children in forward
+    (e.g. Simple_Net, Large_Simple_Net, with a ReLU between conv and BatchNorm) are left as they are.
+    '''
+    num_folded = 0
+    for child in module.children():
+        num_folded += fold_batch_norms(child)
+    if isinstance(module, torch.nn.Sequential):
+        names = list(module._modules)
+        for name, next_name in zip(names[:-1], names[1:]):
+            conv, bn = module._modules[name], module._modules[next_name]
+            if isinstance(conv, torch.nn.Conv2d) and isinstance(bn, torch.nn.BatchNorm2d) and \
+                    bn.track_running_stats and bn.running_mean is not None:
+                module._modules[name] = fuse_conv_bn(conv, bn)
+                module._modules[next_name] = torch.nn.Identity()
+                num_folded += 1
+    return num_folded
+
+
+class AnalysisEngine:
+    '''
+    Executes the statistics pass on a frozen eval mode replica of the network, the trained network itself is not
+    touched. Layers normalize with their running statistics and no autograd graph is recorded (run the pass under
+    context()).
+
+    fold_batch_norm -> Folds Conv2d + BatchNorm2d pairs of Sequential containers. The output of a conv changes with
+                       it, so it is only used when the analysis looks at the outputs of whole stages.
+    compile_stages -> Compiles every stage (child module) with torch.compile.
+    channels_last -> Runs the replica and its 4-D inputs in the channels_last memory format.
+    '''
+    def __init__(self, network: torch.nn.Module, fold_batch_norm: bool=True, compile_stages: bool=False,
+                 channels_last: bool=False):
+        self.network = copy.deepcopy(network).eval()
+        for parameter in self.network.parameters():
+            parameter.requires_grad_(False)
+        self.num_folded = fold_batch_norms(self.network) if fold_batch_norm else 0
+        self.channels_last = channels_last
+        if channels_last:
+            self.network = self.network.to(memory_format=torch.channels_last)
+        self.compile_stages = compile_stages
+        self._stages = None
+
+    def stages(self):
+        # Children of the replica in order, the units the layer-wise pass advances the samples through
+        if self._stages is None:
+            self._stages = list(self.network.children())
+            if self.compile_stages:
+                self._stages = [torch.compile(stage) for stage in self._stages]
+        return self._stages
+
+    def prepare_input(self, values: torch.Tensor, device):
+        values = values.to(device, dtype=torch.float)
+        if self.channels_last and values.dim() == 4:
+            values = values.contiguous(memory_format=torch.channels_last)
+        return values
+
+    @staticmethod
+    def context():
+        return torch.inference_mode()
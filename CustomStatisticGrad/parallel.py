@@ -0,0 +1,226 @@
+import multiprocessing
+import os
+import traceback
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, SequentialSampler, Subset
+
+from CustomStatisticGrad.statistic_metrics import histogramdd_range, histogramdd_counts, histogram_kl
+
+# Same order as CustomStatisticGrad.STREAMS
+STREAMS = ('pre', 'test', 'pre2')
+
+
+def shard_batches(num_batches, num_workers):
+    '''
+    Splits the batch indices 0..num_batches-1 into contiguous blocks, one per worker.
+    '''
+    bounds = np.linspace(0, num_batches, num_workers + 1).astype(int)
+    return [range(bounds[worker], bounds[worker + 1]) for worker in range(num_workers)]
+
+
+def loader_batch_size(loader):
+    # Loaders which sample whole batches (batch_size=None with a BatchSampler) keep the size on the sampler
+    if loader.batch_size is not None:
+        return loader.batch_size
+    return getattr(loader.sampler, 'batch_size', None)
+
+
+def is_sequential(loader):
+    # Loaders which yield their dataset in order, the same samples on every pass
+    sampler = loader.sampler.sampler if isinstance(loader.sampler, BatchSampler) else loader.sampler
+    return isinstance(sampler, SequentialSampler)
+
+
+def available_batches(analysis):
+    '''
+    Number of batches the statistics pass analyses: num_batches + 1, at most the length of the shortest stream.
+    '''
+    loaders = [loader for loader in (analysis.pretrained_data_set, analysis.input_test, analysis.pretrained_data_set2)
+               if loader is not None]
+    return min([analysis.num_batches + 1] + [len(loader) for loader in loaders])
+
+
+def shard_loader(loader, batches):
+    '''
+    DataLoader over the samples of the given batches of loader, which has to yield the dataset in order
+    (a SequentialSampler, no shuffle) so the shards hold the same samples as the single process pass.
+    '''
+    if loader is None:
+        return None
+    if not is_sequential(loader):
+        raise ValueError('The collection is sharded by batch index, got a loader with ' +
+                         loader.sampler.__class__.__name__ + ', use shuffle=False')
+    batch_size = loader_batch_size(loader)
+    if batch_size is None:
+        raise ValueError('The parallel collection shards the loaders by batch_size, got a loader without it')
+    indices = [index for batch in batches
+               for index in range(batch * batch_size, min((batch + 1) * batch_size, len(loader.dataset)))]
+    # A batch sampling loader only converts, the shard samples one by one and needs the default collate
+    collate_fn = loader.collate_fn if loader.batch_size is not None else None
+    return DataLoader(Subset(loader.dataset, indices), batch_size=batch_size, shuffle=False, collate_fn=collate_fn,
+                      num_workers=loader.num_workers)
+
+
+def _receive(connection):
+    message = connection.recv()
+    if message[0] == 'error':
+        raise RuntimeError('Statistics worker failed:\n' + message[1])
+    return message
+
+
+class WorkerStageExchange:
+    '''
+    Worker side of a stage of the layer-wise pass: sends the partial channel statistics and embedding ranges of its
+    samples, histograms its embeddings on the merged bins and receives the similarity and the compensation moments
+    computed from all the samples.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def stage_similarity(self, analysis, name, embeddings):
+        # [#samples, #channels, #dims] -> [#channels, #samples, #dims]
+        embeddings = [stream_embeddings.transpose(0, 1).double() for stream_embeddings in embeddings]
+        self.connection.send(('stage', name, {stream: analysis.channel_stats[stream][name] for stream in STREAMS},
+                              embeddings[0].amin(dim=1), embeddings[0].amax(dim=1)))
+        _, lower, upper = _receive(self.connection)
+        self.connection.send(('histograms', [histogramdd_counts(stream_embeddings, lower, upper)
+                                             for stream_embeddings in embeddings]))
+        _, sim_ch, kernel_mean, kernel_std = _receive(self.connection)
+        analysis.kernel_mean[name] = kernel_mean
+        analysis.kernel_std[name] = kernel_std
+        return sim_ch
+
+
+def _worker_state(analysis, mode, collection):
+    state = {'modules_name_list': analysis.modules_name_list, 'activation_shapes': analysis.activation_shapes}
+    if collection == 'hooks':
+        for key in ('channel_stats', 'channel_reservoirs', 'channel_sketches'):
+            state[key] = {stream: dict(getattr(analysis, key)[stream]) for stream in STREAMS}
+        state['stats_test'] = dict(analysis.stats_test)
+        state['pre_trained_outputs'] = dict(analysis.pre_trained_outputs)
+        if mode == 'per_layer':
+            state['statistic_test'] = dict(analysis.statistic_test)
+            state['statistic_pretrained'] = dict(analysis.statistic_pretrained)
+    return state
+
+
+def _collect_worker(analysis, batches, connection, mode, collection, num_threads):
+    try:
+        torch.set_num_threads(num_threads)
+        if len(batches) == 0:
+            raise ValueError('Statistics worker got no batches to analyse')
+        analysis.pretrained_data_set = shard_loader(analysis.pretrained_data_set, batches)
+        analysis.input_test = shard_loader(analysis.input_test, batches)
+        analysis.pretrained_data_set2 = shard_loader(analysis.pretrained_data_set2, batches)
+        analysis._prepare_input_tensor()
+        # Only the block holding the first batch keeps its first batch untransformed, as the serial collection does
+        analysis._raw_first_batch = batches[0] == 0
+        if collection != 'hooks':
+            analysis._stage_exchange = WorkerStageExchange(connection)
+        analysis._run_collection(batches_num=len(batches) - 1, mode=mode, collection=collection)
+        connection.send(('done', _worker_state(analysis, mode, collection)))
+    except Exception:
+        connection.send(('error', traceback.format_exc()))
+    finally:
+        connection.close()
+
+
+def _reduce_stages(analysis, connections):
+    # Parent side of the layer-wise pass, one iteration per stage until the workers are done
+    while True:
+        messages = [_receive(connection) for connection in connections]
+        if messages[0][0] == 'done':
+            return [message[1] for message in messages]
+        name = messages[0][1]
+        for _, _, stage_stats, _, _ in messages:
+            for stream in STREAMS:
+                analysis.channel_stats[stream][name].merge(stage_stats[stream])
+        lower = torch.stack([message[3] for message in messages]).amin(dim=0)
+        upper = torch.stack([message[4] for message in messages]).amax(dim=0)
+        lower, upper = histogramdd_range(lower, upper)
+        for connection in connections:
+            connection.send(('bins', lower, upper))
+        histograms = [_receive(connection)[1] for connection in connections]
+        hist_pre, hist_test, hist_pre2 = [sum(worker_histograms[ind] for worker_histograms in histograms)
+                                          for ind in range(len(STREAMS))]
+        kl_test = histogram_kl(hist_pre, hist_test)
+        kl_pre2 = histogram_kl(hist_pre, hist_pre2)
+        sim_ch = list((1 / (kl_test * kl_pre2)).cpu().numpy())
+        analysis._kernel_moments(name)
+        analysis.stats_value_per_layer[name] = sim_ch
+        for connection in connections:
+            connection.send(('similarity', sim_ch, analysis.kernel_mean[name], analysis.kernel_std[name]))
+
+
+def _merge_hooked_states(analysis, states, mode):
+    # Worker states in batch order, so the concatenated per kernel values keep the serial order
+    for state in states:
+        for key in ('channel_stats', 'channel_reservoirs', 'channel_sketches'):
+            for stream in STREAMS:
+                for name, accumulator in state[key][stream].items():
+                    getattr(analysis, key)[stream][name].merge(accumulator)
+        for name in state['stats_test']:
+            if np.size(state['stats_test'][name]) <= 1:
+                continue
+            if np.size(analysis.stats_test[name]) <= 1:
+                analysis.stats_test[name] = state['stats_test'][name]
+                analysis.pre_trained_outputs[name] = state['pre_trained_outputs'][name]
+            else:
+                analysis.stats_test[name] = np.concatenate([analysis.stats_test[name], state['stats_test'][name]], axis=1)
+                analysis.pre_trained_outputs[name] = np.concatenate(
+                    [analysis.pre_trained_outputs[name], state['pre_trained_outputs'][name]], axis=1)
+        if mode == 'per_layer':
+            for name in state['statistic_test']:
+                analysis.statistic_test[name].extend(state['statistic_test'][name])
+                analysis.statistic_pretrained[name].extend(state['statistic_pretrained'][name])
+    if mode != 'per_layer':
+        analysis._reservoir_statistics()
+
+
+def parallel_collect(analysis, mode='normal', collection='layer_wise'):
+    '''
+    Runs the statistics pass of a CustomStatisticGrad over analysis.num_workers forked processes.
+    Every worker analyses a contiguous block of the batches with its own copy of the network. The hook collection is
+    a map-reduce: the worker accumulators (moments, histograms, reservoirs, sketches) and per kernel values are merged
+    at the end. The layer-wise pass compensates every stage with the statistics of all the samples, so the workers
+    run it in lock step: per stage the parent merges the channel statistics, sets the embedding bins from the merged
+    ranges, sums the embedding histograms and sends back the similarity and compensation moments. The similarity of
+    the layer-wise pass is the same as the serial one. Merged reservoirs / sketches are samples of the same data but
+    not the same samples.
+    '''
+    if analysis.device.type != 'cpu':
+        raise ValueError('The parallel collection runs on CPU, got device ' + str(analysis.device))
+    num_batches = available_batches(analysis)
+    num_workers = min(analysis.num_workers, num_batches)
+    context = multiprocessing.get_context('fork')
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    connections = []
+    processes = []
+    try:
+        for batches in shard_batches(num_batches, num_workers):
+            parent_connection, worker_connection = context.Pipe()
+            process = context.Process(target=_collect_worker,
+                                      args=(analysis, batches, worker_connection, mode, collection, num_threads))
+            process.start()
+            worker_connection.close()
+            connections.append(parent_connection)
+            processes.append(process)
+        if collection == 'hooks':
+            states = [_receive(connection)[1] for connection in connections]
+            _merge_hooked_states(analysis, states, mode)
+        else:
+            analysis.kernel_mean = defaultdict(list)
+            analysis.kernel_std = defaultdict(list)
+            states = _reduce_stages(analysis, connections)
+        analysis.modules_name_list = list(states[0]['modules_name_list'])
+        for state in states:
+            analysis.activation_shapes.update(state['activation_shapes'])
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+
+
+def log_abs_filter(values, weights, threshold=1e-7):
+    '''
+    log(|x|) of the values with |x| > threshold, as done before the similarity tests (log normal assumption).
+    Filtered values get zero weight and +inf so they sort after every kept value.
+    '''
+    keep = values.abs() > threshold
+    values = torch.where(keep, torch.log(values.abs().clamp_min(threshold)), torch.full_like(values, np.inf))
+    return values, torch.where(keep, weights, torch.zeros_like(weights))
+
+
+def _sorted_cdf_difference(values_a, weights_a, values_b, weights_b):
+    # Difference of the two weighted empirical cdfs after every value of the sorted union of both samples
+    values_a, values_b = values_a.double(), values_b.double()
+    weights_a = weights_a.double() / weights_a.double().sum(dim=1, keepdim=True)
+    weights_b = weights_b.double() / weights_b.double().sum(dim=1, keepdim=True)
+    values, order = torch.sort(torch.cat([values_a, values_b], dim=1), dim=1)
+    cdf_difference = torch.cumsum(torch.gather(torch.cat([weights_a, -weights_b], dim=1), 1, order), dim=1)
+    return values, cdf_difference
+
+
+def ks_distance(values_a, weights_a, values_b, weights_b):
+    '''
+    Two sample Kolmogorov-Smirnov statistic per channel between weighted samples [#channels, #values].
+    Zero weights mark padding / filtered values.
+    '''
+    values, cdf_difference = _sorted_cdf_difference(values_a, weights_a, values_b, weights_b)
+    # Inside a run of equal values only the last position is a point of both step functions
+    last_of_run = torch.ones_like(values, dtype=torch.bool)
+    last_of_run[:, :-1] = values[:, 1:] != values[:, :-1]
+    return torch.where(last_of_run, cdf_difference.abs(), torch.zeros_like(cdf_difference)).amax(dim=1)
+
+
+def wasserstein_distance(values_a, weights_a, values_b, weights_b):
+    '''
+    1-D Wasserstein distance per channel between weighted samples [#channels, #values], the integral of the absolute
+    difference of the two cdfs. Zero weights mark padding / filtered values.
+    '''
+    values, cdf_difference = _sorted_cdf_difference(values_a, weights_a, values_b, weights_b)
+    deltas = values[:, 1:] - values[:, :-1]
+    # Steps into the +inf padding carry no mass
+    deltas = torch.where(torch.isfinite(deltas), deltas, torch.zeros_like(deltas))
+    return (cdf_difference[:, :-1].abs() * deltas).sum(dim=1)
+
+
+def stack_channels(channels):
+    '''
+    Stacks the per channel value arrays of a layer into a padded tensor [#channels, #max values] (float64) and the
+    matching weights, 1 for the values and 0 for the padding.
+    '''
+    channels = [torch.as_tensor(np.asarray(channel, dtype=np.float64)).ravel() for channel in channels]
+    max_len = max(len(channel) for channel in channels)
+    values = torch.full((len(channels), max_len), np.inf, dtype=torch.float64)
+    weights = torch.zeros((len(channels), max_len), dtype=torch.float64)
+    for ind, channel in enumerate(channels):
+        values[ind, :len(channel)] = channel
+        weights[ind, :len(channel)] = 1
+    return values, weights
+
+
+def layer_similarity(test_channels, pre_channels, similarity='ws', min_values=20, device=None):
+    '''
+    Per channel similarity (1 / distance) of all kernels of a layer in one vectorized pass, equal to running
+    stats.ks_2samp / scipy.stats.wasserstein_distance on log(|x|) of every kernel separately. Channels with min_values
+    or less values left get -1.
+    '''
+    values_test, weights_test = log_abs_filter(*stack_channels(test_channels))
+    values_pre, weights_pre = log_abs_filter(*stack_channels(pre_channels))
+    if device is not None:
+        values_test, weights_test = values_test.to(device), weights_test.to(device)
+        values_pre, weights_pre = values_pre.to(device), weights_pre.to(device)
+    if similarity == 'KS':
+        distance = ks_distance(values_test, weights_test, values_pre, weights_pre)
+    elif similarity == 'ws':
+        distance = wasserstein_distance(values_test, weights_test, values_pre, weights_pre)
+    else:
+        raise ValueError('Similarity ' + similarity + ' is not supported by the vectorized comparison, use KS or ws')
+    sim = 1 / (1e-8 + distance)
+    enough_values = ((weights_test > 0).sum(dim=1) > min_values) & ((weights_pre > 0).sum(dim=1) > min_values)
+    return torch.where(enough_values, sim, torch.full_like(sim, -1)).cpu().numpy()
+
+
+def sketch_similarity(sketch_test, sketch_pre, similarity='ws', min_values=20):
+    '''
+    Per channel similarity (1 / distance) between the quantile sketches of the new and the pretrained dataset.
+    The distance is measured on log(|x|) like the sample based metric; channels with min_values or less (estimated)
+    values left get -1.
+    '''
+    values_test, weights_test = log_abs_filter(*sketch_test.weighted_samples())
+    values_pre, weights_pre = log_abs_filter(*sketch_pre.weighted_samples())
+    if similarity == 'KS':
+        distance = ks_distance(values_test, weights_test, values_pre, weights_pre)
+    elif similarity == 'ws':
+        distance = wasserstein_distance(values_test, weights_test, values_pre, weights_pre)
+    else:
+        raise ValueError('Similarity ' + similarity + ' is not supported on quantile sketches, use KS or ws')
+    sim = 1 / (1e-8 + distance)
+    enough_values = (weights_test.sum(dim=1) > min_values) & (weights_pre.sum(dim=1) > min_values)
+    return torch.where(enough_values, sim, torch.full_like(sim, -1)).cpu().numpy()
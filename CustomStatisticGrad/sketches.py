@@ -0,0 +1,68 @@
+import numpy as np
+import torch
+
+
+class ChannelQuantileSketch:
+    '''
+    Mergeable quantile sketch per channel (KLL style compactors).
+    Level l holds items of weight 2**l. When a level exceeds its capacity it is sorted and every other item (random
+    offset) is promoted to the next level, so memory depends on k and only grows logarithmically with the number of
+    values. All channels receive the same number of values, so the levels of all channels are kept in one
+    [#channels, #items] tensor per level and compacted together.
+    Sketches of different batches / workers are combined with merge().
+    '''
+    def __init__(self, k: int=256, seed: int=0):
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.levels = []
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.shape[1] > self._capacity(level):
+                items = torch.sort(items, dim=1).values
+                num_paired = items.shape[1] // 2 * 2
+                offset = int(self.rng.integers(0, 2))
+                if level + 1 == len(self.levels):
+                    self.levels.append(items[:, :0])
+                self.levels[level + 1] = torch.cat([self.levels[level + 1], items[:, offset:num_paired:2]], dim=1)
+                # An odd item out stays at its level
+                self.levels[level] = items[:, num_paired:]
+            level += 1
+
+    def update(self, values):
+        '''
+        Adds values [#channels, #values] to the sketch.
+        '''
+        values = torch.as_tensor(values).detach()
+        if len(self.levels) == 0:
+            self.levels.append(values[:, :0])
+        self.levels[0] = torch.cat([self.levels[0], values.to(self.levels[0])], dim=1)
+        self._compress()
+        return self
+
+    def merge(self, other: 'ChannelQuantileSketch'):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(items[:, :0])
+            self.levels[level] = torch.cat([self.levels[level], items.to(self.levels[level])], dim=1)
+        self._compress()
+        return self
+
+    @property
+    def count(self):
+        return sum(items.shape[1] * 2 ** level for level, items in enumerate(self.levels))
+
+    def weighted_samples(self):
+        '''
+        Items of all levels [#channels, #items] and their weights [#channels, #items].
+        '''
+        values = torch.cat(self.levels, dim=1)
+        weights = torch.cat([torch.full((items.shape[1],), 2.0 ** level, dtype=torch.float64)
+                             for level, items in enumerate(self.levels)])
+        return values, weights.to(values.device).expand(values.shape[0], -1)
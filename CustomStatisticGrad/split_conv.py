@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+
+
+def _sub_conv(conv: torch.nn.Conv2d, index: torch.Tensor, trainable: bool):
+    # Conv2d computing the output channels index of conv
+    sub_conv = torch.nn.Conv2d(conv.in_channels, len(index), conv.kernel_size, stride=conv.stride,
+                               padding=conv.padding, dilation=conv.dilation, bias=conv.bias is not None,
+                               padding_mode=conv.padding_mode, device=conv.weight.device, dtype=conv.weight.dtype)
+    with torch.no_grad():
+        sub_conv.weight.copy_(conv.weight.index_select(0, index))
+        if conv.bias is not None:
+            sub_conv.bias.copy_(conv.bias.index_select(0, index))
+    sub_conv.requires_grad_(trainable)
+    return sub_conv
+
+
+class SplitConv2d(torch.nn.Module):
+    '''
+    Conv2d (groups 1) split by output channel into a frozen (requires_grad=False) and a trainable sub-convolution over
+    the same input, their outputs are concatenated back in the original channel order. Autograd computes the weight
+    gradient of the trainable kernels only; the input gradient still goes through all the kernels.
+    '''
+    def __init__(self, conv: torch.nn.Conv2d, trainable_channels):
+        super(SplitConv2d, self).__init__()
+        if conv.groups != 1:
+            raise ValueError('Only convolutions with groups 1 are split, got groups ' + str(conv.groups))
+        trainable = np.zeros(conv.out_channels, dtype=bool)
+        trainable[np.asarray(trainable_channels, dtype=int)] = True
+        device = conv.weight.device
+        frozen_index = torch.as_tensor(np.flatnonzero(~trainable), device=device)
+        trainable_index = torch.as_tensor(np.flatnonzero(trainable), device=device)
+        self.frozen = _sub_conv(conv, frozen_index, trainable=False)
+        self.trainable = _sub_conv(conv, trainable_index, trainable=True)
+        # Position of every original channel in the concatenated [frozen, trainable] output
+        self.register_buffer('order', torch.argsort(torch.cat([frozen_index, trainable_index])))
+
+    def forward(self, x):
+        return torch.cat([self.frozen(x), self.trainable(x)], dim=1).index_select(1, self.order)
+
+    def to_conv(self):
+        '''
+        Plain trainable Conv2d with the current kernels of both parts.
+        '''
+        parts = self.frozen, self.trainable
+        conv = torch.nn.Conv2d(self.frozen.in_channels, len(self.order), self.frozen.kernel_size,
+                               stride=self.frozen.stride, padding=self.frozen.padding, dilation=self.frozen.dilation,
+                               bias=self.frozen.bias is not None, padding_mode=self.frozen.padding_mode,
+                               device=self.order.device, dtype=self.frozen.weight.dtype)
+        with torch.no_grad():
+            conv.weight.copy_(torch.cat([part.weight for part in parts]).index_select(0, self.order))
+            if conv.bias is not None:
+                conv.bias.copy_(torch.cat([part.bias for part in parts]).index_select(0, self.order))
+        return conv
+
+
+def _replace_module(net, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    parent = net.get_submodule(parent_name) if parent_name else net
+    parent._modules[child_name] = module
+
+
+def split_convolutions(net, layers_grad_mult):
+    '''
+    Replaces every Conv2d whose weight mask (per output channel, _require_grad_search) freezes some but not all of its
+    output channels by a SplitConv2d with the channels of mask 1 trainable. Returns the number of split convolutions.
+    The frozen channels (weights and biases) get no update at all, instead of the small multiplier of the mask, and
+    the split convolutions are skipped by GradientMasks / update_grads. This matches the normal freezing mode only:
+    freeze_except_bias trains the biases and scales the weights by an epoch dependent multiplier.
+    '''
+    modules = dict(net.named_modules())
+    num_split = 0
+    for name, masks in layers_grad_mult.items():
+        conv = modules.get(name)
+        if not isinstance(conv, torch.nn.Conv2d) or conv.groups != 1 or 'weights' not in masks:
+            continue
+        mask = np.reshape(masks['weights'], -1)
+        if len(mask) != conv.out_channels:
+            continue
+        trainable_channels = np.flatnonzero(mask >= 1)
+        if 0 < len(trainable_channels) < conv.out_channels:
+            _replace_module(net, name, SplitConv2d(conv, trainable_channels))
+            num_split += 1
+    return num_split
+
+
+def merge_convolutions(net):
+    '''
+    Inverse of split_convolutions: every SplitConv2d becomes a plain Conv2d again (e.g. to export the state_dict).
+    '''
+    split_names = [name for name, module in net.named_modules() if isinstance(module, SplitConv2d)]
+    for name in split_names:
+        _replace_module(net, name, net.get_submodule(name).to_conv())
+    return len(split_names)
@@ -19,3 +19,69 @@ def smoothed_hist_kl_distance(a, b, nbins=20):
     ahist, bhist = (np.histogram(a, bins=nbins)[0],
                     np.histogram(b, bins=nbins)[0])
     return kl(ahist, bhist)
+
+def _histogramdd_codes(samples, lower, upper, bins):
+    # Linear bin code of every sample [#channels, #samples, #dims] as np.histogramdd assigns them to bins edges
+    # linspace(lower, upper, bins + 1) per channel and dim. Samples outside the edges get code -1.
+    num_dims = samples.shape[-1]
+    steps = torch.arange(bins + 1, dtype=torch.float64, device=samples.device)
+    edges = lower.unsqueeze(-1) + steps * ((upper - lower) / bins).unsqueeze(-1)
+    edges[..., -1] = upper
+    # -> [#channels, #dims, #samples]
+    values = samples.transpose(1, 2).contiguous()
+    inds = torch.searchsorted(edges.contiguous(), values, right=True) - 1
+    # Values on the rightmost edge belong to the last bin
+    inds[values == upper.unsqueeze(-1)] = bins - 1
+    inside = ((inds >= 0) & (inds < bins)).all(dim=1)
+    multipliers = bins ** torch.arange(num_dims - 1, -1, -1, device=samples.device)
+    codes = (inds * multipliers.view(1, -1, 1)).sum(dim=1)
+    return torch.where(inside, codes, torch.full_like(codes, -1))
+
+
+def _channel_histograms(codes, num_bins):
+    # One bincount for all channels, every channel gets its own range of num_bins bins
+    num_channels = codes.shape[0]
+    inside = codes >= 0
+    offsets = torch.arange(num_channels, device=codes.device).unsqueeze(1) * num_bins
+    return torch.bincount((codes + offsets)[inside], minlength=num_channels * num_bins).view(
+        num_channels, num_bins).double()
+
+
+def histogramdd_range(lower, upper):
+    # Constant dims get a unit wide range, as in np.histogramdd
+    constant = lower == upper
+    return torch.where(constant, lower - 0.5, lower), torch.where(constant, upper + 0.5, upper)
+
+
+def histogramdd_counts(samples, lower, upper, bins=10):
+    '''
+    Histograms [#channels, bins ** #dims] of samples [#channels, #samples, #dims] over the bins np.histogramdd builds
+    for the range lower / upper [#channels, #dims]. Counts of sample subsets add up to the counts of all samples.
+    '''
+    samples = torch.as_tensor(samples).double()
+    return _channel_histograms(_histogramdd_codes(samples, lower, upper, bins), bins ** samples.shape[-1])
+
+
+def histogram_kl(hist_reference, hist_other, eps=1e-4):
+    # scipy.stats.entropy of the eps smoothed, normalized histograms, per channel
+    p = hist_reference / hist_reference.sum(dim=1, keepdim=True) + eps
+    p = p / p.sum(dim=1, keepdim=True)
+    q = hist_other / hist_other.sum(dim=1, keepdim=True) + eps
+    q = q / q.sum(dim=1, keepdim=True)
+    return (p * torch.log(p / q)).sum(dim=1)
+
+
+def batched_histogramdd_kl(reference, others, bins=10, eps=1e-4):
+    '''
+    KL divergence between the multi dimensional histogram of the reference samples and the histograms of other
+    samples over the reference bins, for all channels at once.
+    reference -> [#channels, #samples, #dims], others -> list of [#channels, #samples, #dims].
+    Returns [len(others), #channels], the values of
+    entropy(hist(reference) / sum + eps, hist(other, reference bins) / sum + eps) with np.histogramdd(bins=bins).
+    '''
+    reference = torch.as_tensor(reference).double()
+    lower, upper = histogramdd_range(reference.amin(dim=1), reference.amax(dim=1))
+    hist_reference = histogramdd_counts(reference, lower, upper, bins)
+    return torch.stack([histogram_kl(hist_reference, histogramdd_counts(torch.as_tensor(other).to(reference),
+                                                                         lower, upper, bins), eps)
+                        for other in others])
@@ -7,6 +7,10 @@ import torch.nn.functional as F
 from torchvision import models
 
 import torch
+
+from datasets.batch_transforms import BatchTransform, BatchCollate
+from datasets.data_utils import ClassSubset
+
 transform = transforms.Compose([transforms.Resize((64, 64)),
                                 transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5),
                                                                             (0.5, 0.5, 0.5))])
@@ -93,12 +97,17 @@ if __name__ == '__main__':
     #testloader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size,
      #                                     shuffle=False)
 
-    dataset_first = datasets.KMNIST(root='.', train=True, download=True,transform=transformMnist)
-    trainloader = torch.utils.data.DataLoader(dataset_first, batch_size=batch_size, shuffle=True)
+    # Same tensors as transformMnist, computed for the whole uint8 batch in the collate
+    collate_mnist = BatchCollate(BatchTransform(size=(64, 64), mean=(0.1307,), std=(0.3081,), channels=3,
+                                                grayscale=True))
+    # Only the upper classes 5 to 10 (targets 0 to 5) are loaded
+    dataset_first = ClassSubset(datasets.KMNIST(root='.', train=True, download=True), middle_range=5, upper=True)
+    trainloader = torch.utils.data.DataLoader(dataset_first, batch_size=batch_size, shuffle=True,
+                                              collate_fn=collate_mnist)
 
-    dataset_test = datasets.KMNIST(root='.', train=False, download=True,transform=transformMnist)
+    dataset_test = ClassSubset(datasets.KMNIST(root='.', train=False, download=True), middle_range=5, upper=True)
     testloader = torch.utils.data.DataLoader(dataset_test, batch_size=batch_size,
-                                              shuffle=False)
+                                              shuffle=False, collate_fn=collate_mnist)
 
 
     #network = Simple_Net().cuda()
@@ -124,11 +133,6 @@ if __name__ == '__main__':
             # get the inputs; data is a list of [inputs, labels]
             optimizer.zero_grad()
             inputs, labels = data
-            ind_to_train = np.where(labels >= 5 )
-            if len(ind_to_train[0]) == 0:
-                continue
-            labels = labels[ind_to_train[0]] - 5
-            inputs = inputs[ind_to_train[0]]
             #plt.imshow(inputs.detach().cpu().numpy()[0].transpose())
             outputs = network(inputs.cuda())
             loss = criterion(outputs, labels.cuda())
@@ -147,11 +151,6 @@ if __name__ == '__main__':
             for data in testloader:
                 count += 1
                 images, labels = data
-                ind_to_train = np.where(labels >= 5)
-                if len(ind_to_train[0]) == 0:
-                    continue
-                labels = labels[ind_to_train[0]] - 5
-                images = images[ind_to_train[0]]
 
                 outputs = network(images.cuda())
                 _, predicted = torch.max(outputs.data, 1)
@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import default_collate
+from torchvision import transforms
+
+
+class BatchTransform:
+    '''
+    Tensor version of the ToTensor / Resize / Normalize chains for a whole uint8 batch at once:
+    [B, H, W] or [B, H, W, C] uint8 -> [B, channels, size] float, scaled to [0, 1], resized with one bilinear
+    F.interpolate and normalized. With grayscale, only the first channel of the batch is processed and the result is
+    expanded to channels (the grayscale datasets replicate one channel).
+    '''
+    def __init__(self, size=(64, 64), mean=(0.1307,), std=(0.3081,), channels: int=3, grayscale: bool=False,
+                 antialias: bool=True):
+        self.size = size
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+        self.channels = channels
+        self.grayscale = grayscale
+        self.antialias = antialias
+
+    @classmethod
+    def from_compose(cls, compose: transforms.Compose, channels: int=3, grayscale: bool=False):
+        '''
+        BatchTransform equal (within interpolation tolerance) to a Compose of ToTensor, Resize and Normalize.
+        '''
+        size, mean, std = None, (0.0,), (1.0,)
+        for transform in compose.transforms:
+            if isinstance(transform, transforms.Resize):
+                size = (transform.size, transform.size) if isinstance(transform.size, int) else tuple(transform.size)
+            elif isinstance(transform, transforms.Normalize):
+                mean, std = tuple(np.ravel(transform.mean)), tuple(np.ravel(transform.std))
+            elif not isinstance(transform, transforms.ToTensor):
+                raise ValueError('No batch version of ' + transform.__class__.__name__)
+        return cls(size=size, mean=mean, std=std, channels=channels, grayscale=grayscale)
+
+    def __call__(self, images):
+        images = torch.as_tensor(images)
+        if images.dim() == 3:
+            images = images.unsqueeze(1)
+        elif self.grayscale:
+            images = images[..., :1].permute(0, 3, 1, 2)
+        else:
+            images = images.permute(0, 3, 1, 2)
+        images = images.float() / 255
+        if self.size is not None and tuple(images.shape[2:]) != tuple(self.size):
+            images = F.interpolate(images, size=self.size, mode='bilinear', align_corners=False,
+                                   antialias=self.antialias)
+        images = (images - self.mean) / self.std
+        if images.shape[1] == 1 and self.channels > 1:
+            images = images.expand(-1, self.channels, -1, -1)
+        return images.contiguous()
+
+
+class BatchCollate:
+    '''
+    collate_fn which stacks the untransformed images of a batch and applies a BatchTransform to all of them at once.
+    '''
+    def __init__(self, batch_transform: BatchTransform):
+        self.batch_transform = batch_transform
+
+    def __call__(self, samples):
+        images = np.stack([np.asarray(image) for image, _ in samples])
+        return self.batch_transform(images), default_collate([target for _, target in samples])
+
+
+def use_batch_transforms(loader):
+    '''
+    Moves the per sample transform of the loader dataset to the collate stage of the loader. Loaders sharing a
+    dataset share its batch transform.
+    '''
+    if loader is None or getattr(loader.dataset, 'transform', None) is None and \
+            not hasattr(loader.dataset, 'batch_transform'):
+        return loader
+    dataset = loader.dataset
+    if not hasattr(dataset, 'batch_transform'):
+        # From now on the grayscale subsets yield their raw single channel images [H, W], the batch transform
+        # processes [B, H, W] and expands the result to the channels
+        dataset.batch_transform = BatchTransform.from_compose(dataset.transform,
+                                                              grayscale=getattr(dataset, 'grayscale', False))
+        dataset.transform = None
+    loader.collate_fn = BatchCollate(dataset.batch_transform)
+    return loader
@@ -2,79 +2,69 @@ import torch
 import numpy as np
 from torchvision import transforms, datasets
 from torchvision.datasets import KMNIST, MNIST
+from torch.utils.data import Dataset, Sampler
 #CIFAR10 = datasets.CIFAR10(root='.', train=True, download=True)
 
 from PIL import Image
-class cifar_part(datasets.cifar.CIFAR10):
-    def __init__(self, transform, train=True,middle_range=5 ,upper= True):
-        super(cifar_part, self).__init__(root='.', train=train)
-        self.transform = transform
-        if upper:
-            indexes_dataset = np.where(np.array(self.targets) >= middle_range)[0]
-            self.targets = [self.targets[ind]- middle_range for ind in indexes_dataset]
-        else:
-            indexes_dataset = np.where(np.array(self.targets) < middle_range)[0]
-            self.targets = [self.targets[ind] for ind in indexes_dataset]
-        self.data= self.data[indexes_dataset]
-# size data cifar10 (25000, 32, 32, 3)
-class kmnist_part(KMNIST):
-    def __init__(self, transform, train=True,middle_range=5 ,upper= True ,shuffle=False):
-        super(kmnist_part, self).__init__(root='.', train=train,download=True)
-        self.transform = transform
 
-        if upper: # Take upper classes 5 to 10
-            indexes_dataset = np.where(np.array(self.targets) >= middle_range)[0]
-            if shuffle:
-                rand_indexes = np.random.permutation(len(indexes_dataset))
-                self.targets = [self.targets[ind].numpy() - middle_range for ind in indexes_dataset[rand_indexes]]
-            else:
-                self.targets = [self.targets[ind].numpy() - middle_range for ind in indexes_dataset]
 
-        else:
-            indexes_dataset = np.where(np.array(self.targets) < middle_range)[0]
-            if shuffle:
-                rand_indexes = np.random.permutation(len(indexes_dataset))
-                self.targets = [self.targets[ind].numpy() for ind in  indexes_dataset[rand_indexes]]
-            else:
-                self.targets = [self.targets[ind].numpy() for ind in  indexes_dataset]
-
-        self.data= self.data[indexes_dataset]
-        temp_data = torch.unsqueeze(self.data, dim=3)
-        self.data = torch.repeat_interleave(temp_data,3,dim=3).numpy()
-    def __getitem__(self, index: int):
-        """
-        Args:
-            index (int): Index
-
-        Returns:
-            tuple: (image, target) where target is index of the target class.
-        """
-        img, target = self.data[index], self.targets[index]
-
-        # doing this so that it is consistent with all other datasets
-        # to return a PIL Image
-        if self.transform is not None:
-            img = self.transform(img)
-
-        if self.target_transform is not None:
-            target = self.target_transform(target)
+def grayscale_as_rgb(img, transform=None):
+    '''
+    Three channel version of a single channel image [H, W] as a broadcast view, no replicated copy is stored.
+    The transform runs on the single channel (ToTensor gives [1, H, W]) and its output is expanded to 3 channels,
+    which equals transforming the replicated image for the channel independent transforms we use (ToTensor, Resize,
+    Normalize with a single mean / std). Without a transform the result is [H, W, 3].
+    '''
+    if transform is None:
+        return np.broadcast_to(img[..., None], img.shape + (3,))
+    img = transform(img)
+    if torch.is_tensor(img) and img.dim() == 3 and img.shape[0] == 1:
+        return img.expand(3, -1, -1)
+    return img
+
+
+def class_split_indices(targets, middle_range=5, upper=True):
+    '''
+    Indices of the samples whose class is >= middle_range (upper) or < middle_range.
+    '''
+    targets = np.asarray(targets)
+    return np.flatnonzero(targets >= middle_range if upper else targets < middle_range)
+
+
+# One in-memory copy per dataset class and split, shared by all its class subsets
+_base_datasets = {}
+
+
+def base_dataset(dataset_class, train=True, **kwargs):
+    key = (dataset_class, train)
+    if key not in _base_datasets:
+        _base_datasets[key] = dataset_class(root='.', train=train, **kwargs)
+    return _base_datasets[key]
+
+
+class ClassSubset(Dataset):
+    '''
+    View of the upper (class >= middle_range, targets shifted by middle_range) or lower (class < middle_range)
+    classes of a base dataset holding data [N, H, W] (grayscale) or [N, H, W, C] and targets [N].
+    Only an index array is stored, the upper and lower subsets of a base dataset read the same data.
+    Grayscale images go through grayscale_as_rgb, color images through a PIL image as in CIFAR10. Once
+    use_batch_transforms moved the transform to the loader collate, grayscale images are returned raw [H, W].
+    '''
+    def __init__(self, base, transform=None, middle_range=5, upper=True, shuffle=False):
+        self.base = base
+        self.transform = transform
+        self.indices = class_split_indices(base.targets, middle_range, upper)
+        if shuffle:
+            self.indices = self.indices[np.random.permutation(len(self.indices))]
+        self.targets = np.asarray(base.targets)[self.indices] - (middle_range if upper else 0)
 
-        return img, target
+    @property
+    def grayscale(self):
+        return np.ndim(self.base.data) == 3
 
-class mnist_part(MNIST):
-    def __init__(self, transform, train=True,middle_range=5 ,upper= True):
-        super(mnist_part, self).__init__(root='.', train=train,download=True)
-        self.transform = transform
-        if upper:
-            indexes_dataset = np.where(np.array(self.targets) >= middle_range)[0]
-            self.targets = [self.targets[ind].numpy()- middle_range for ind in indexes_dataset]
-        else:
-            indexes_dataset = np.where(np.array(self.targets) < middle_range)[0]
-            self.targets = [self.targets[ind].numpy() for ind in indexes_dataset]
+    def __len__(self):
+        return len(self.indices)
 
-        self.data= self.data[indexes_dataset]
-        temp_data = torch.unsqueeze(self.data, dim=3)
-        self.data = torch.repeat_interleave(temp_data,3,dim=3).numpy()
     def __getitem__(self, index: int):
         """
         Args:
@@ -83,48 +73,50 @@ class mnist_part(MNIST):
         Returns:
             tuple: (image, target) where target is index of the target class.
         """
-        img, target = self.data[index], self.targets[index]
+        img, target = np.asarray(self.base.data[self.indices[index]]), int(self.targets[index])
+        if img.ndim == 2:
+            # With a batch transform the loader collate transforms and expands the raw single channel batch
+            if getattr(self, 'batch_transform', None) is None:
+                img = grayscale_as_rgb(img, self.transform)
+        elif self.transform is not None:
+            img = self.transform(Image.fromarray(img))
+        else:
+            img = Image.fromarray(img)
+        return img, target
 
-        # doing this so that it is consistent with all other datasets
-        # to return a PIL Image
-        if self.transform is not None:
-            img = self.transform(img)
 
-        if self.target_transform is not None:
-            target = self.target_transform(target)
+class ClassSampler(Sampler):
+    '''
+    Sampler over a whole base dataset which yields only the indices of the upper or lower classes (targets keep their
+    base values), so the other classes are never loaded.
+    '''
+    def __init__(self, targets, middle_range=5, upper=True, shuffle=False):
+        self.indices = class_split_indices(targets, middle_range, upper)
+        self.shuffle = shuffle
 
-        return img, target
+    def __len__(self):
+        return len(self.indices)
 
-class Fmnist_part(MNIST):
-    def __init__(self, transform, train=True,middle_range=5 ,upper= True):
-        super(Fmnist_part, self).__init__(root='.', train=train,download=True)
-        self.transform = transform
-        if upper:
-            indexes_dataset = np.where(np.array(self.targets) >= middle_range)[0]
-            self.targets = [self.targets[ind].numpy()- middle_range for ind in indexes_dataset]
-        else:
-            indexes_dataset = np.where(np.array(self.targets) < middle_range)[0]
-            self.targets = [self.targets[ind].numpy() for ind in indexes_dataset]
+    def __iter__(self):
+        if self.shuffle:
+            return iter(self.indices[torch.randperm(len(self.indices))].tolist())
+        return iter(self.indices.tolist())
 
-        self.data= self.data[indexes_dataset]
-        temp_data = torch.unsqueeze(self.data, dim=3)
-        self.data = torch.repeat_interleave(temp_data,3,dim=3).numpy()
-    def __getitem__(self, index: int):
-        """
-        Args:
-            index (int): Index
 
-        Returns:
-            tuple: (image, target) where target is index of the target class.
-        """
-        img, target = self.data[index], self.targets[index]
-
-        # doing this so that it is consistent with all other datasets
-        # to return a PIL Image
-        if self.transform is not None:
-            img = self.transform(img)
+class cifar_part(ClassSubset):
+    def __init__(self, transform, train=True,middle_range=5 ,upper= True):
+        super(cifar_part, self).__init__(base_dataset(datasets.CIFAR10, train), transform, middle_range, upper)
+# size data cifar10 (25000, 32, 32, 3)
+class kmnist_part(ClassSubset):
+    def __init__(self, transform, train=True,middle_range=5 ,upper= True ,shuffle=False):
+        # Take upper classes 5 to 10 or lower classes 0 to 5
+        super(kmnist_part, self).__init__(base_dataset(KMNIST, train, download=True), transform, middle_range, upper,
+                                          shuffle)
 
-        if self.target_transform is not None:
-            target = self.target_transform(target)
+class mnist_part(ClassSubset):
+    def __init__(self, transform, train=True,middle_range=5 ,upper= True):
+        super(mnist_part, self).__init__(base_dataset(MNIST, train, download=True), transform, middle_range, upper)
 
-        return img, target
+class Fmnist_part(ClassSubset):
+    def __init__(self, transform, train=True,middle_range=5 ,upper= True):
+        super(Fmnist_part, self).__init__(base_dataset(MNIST, train, download=True), transform, middle_range, upper)
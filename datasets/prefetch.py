@@ -0,0 +1,68 @@
+import queue
+import threading
+
+import torch
+
+_END = object()
+
+
+class BackgroundLoader:
+    '''
+    Iterates a DataLoader in a background thread, up to depth batches ahead, so loading and transforming the next
+    batches overlaps the work done on the current one. One BackgroundLoader per stream lets the pretrained, new and
+    second pretrained streams load concurrently when they are zipped.
+    The images of every batch (first element) are made contiguous and, with a device, moved there from pinned memory.
+    '''
+    def __init__(self, loader, depth: int=2, device=None):
+        self.loader = loader
+        self.depth = depth
+        self.device = None if device is None else torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _prepare(self, batch):
+        images = batch[0].contiguous()
+        if self.device is not None and self.device.type == 'cuda':
+            images = images.pin_memory().to(self.device, non_blocking=True)
+        elif self.device is not None:
+            images = images.to(self.device)
+        return (images,) + tuple(batch[1:])
+
+    @staticmethod
+    def _put(batches, item, stop):
+        # Waits for a free slot, gives up when the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fill(self, batches, stop):
+        try:
+            for batch in self.loader:
+                if not self._put(batches, self._prepare(batch), stop):
+                    return
+        except Exception as error:
+            self._put(batches, error, stop)
+            return
+        self._put(batches, _END, stop)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._fill, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Also reached when the consumer breaks out early (e.g. after batches_num batches)
+            stop.set()
@@ -0,0 +1,114 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, SequentialSampler
+
+
+def cache_config(dataset, transform=None, dtype: str='float16'):
+    # What the cached tensors depend on, a cache written with another config is rebuilt
+    transform = transform if transform is not None else getattr(dataset, 'transform', None)
+    return {'dataset': dataset.__class__.__name__, 'transform': repr(transform), 'dtype': str(np.dtype(dtype)),
+            'length': len(dataset)}
+
+
+def read_cache_metadata(path: str):
+    if not os.path.exists(os.path.join(path, 'metadata.json')):
+        return {}
+    with open(os.path.join(path, 'metadata.json'), 'r') as f:
+        return json.load(f)
+
+
+def build_tensor_cache(dataset, path: str, transform=None, dtype: str='float16', batch_size: int=256):
+    '''
+    Applies a deterministic transform once to every sample of dataset and writes the results to path as a
+    memory-mapped images.npy [N, ...] (dtype float16 / float32, or uint8 for transforms which keep the byte range)
+    and labels.npy [N], with the cache_config in metadata.json.
+    transform replaces dataset.transform while the cache is built, None uses the transform of the dataset.
+    The images of the grayscale subsets (replicated channels) are stored single channel.
+    '''
+    if not os.path.exists(path):
+        os.makedirs(path)
+    if os.path.exists(os.path.join(path, 'metadata.json')):
+        os.remove(os.path.join(path, 'metadata.json'))
+    config = cache_config(dataset, transform, dtype)
+    grayscale = getattr(dataset, 'grayscale', False)
+    dataset_transform = getattr(dataset, 'transform', None)
+    if transform is not None:
+        dataset.transform = transform
+    try:
+        images = None
+        channels = None
+        labels = np.zeros(len(dataset), dtype=np.int64)
+        for start in range(0, len(dataset), batch_size):
+            samples = [dataset[index] for index in range(start, min(start + batch_size, len(dataset)))]
+            batch = np.stack([np.asarray(image) for image, _ in samples])
+            if grayscale and torch.is_tensor(samples[0][0]) and batch.ndim == 4:
+                # [B, C, H, W] with C identical channels -> [B, 1, H, W]
+                channels = batch.shape[1]
+                batch = batch[:, :1]
+            if images is None:
+                images = np.lib.format.open_memmap(os.path.join(path, 'images.npy'), mode='w+', dtype=np.dtype(dtype),
+                                                   shape=(len(dataset),) + batch.shape[1:])
+            images[start:start + len(batch)] = batch.astype(dtype)
+            labels[start:start + len(batch)] = [int(label) for _, label in samples]
+        if images is None:
+            raise ValueError('Cannot cache an empty dataset: ' + path)
+        images.flush()
+        np.save(os.path.join(path, 'labels.npy'), labels)
+    finally:
+        if transform is not None:
+            dataset.transform = dataset_transform
+    # Only the reduced caches are expanded back when read
+    config['channels'] = channels
+    with open(os.path.join(path, 'metadata.json'), 'w') as f:
+        json.dump(config, f)
+
+
+def open_tensor_cache(dataset, path: str, transform=None, dtype: str='float16'):
+    '''
+    TensorCacheDataset over the cache of dataset at path, (re)built when it is missing or was written with another
+    transform, dtype or dataset length.
+    '''
+    metadata = read_cache_metadata(path)
+    config = cache_config(dataset, transform, dtype)
+    if any(metadata.get(key) != value for key, value in config.items()):
+        build_tensor_cache(dataset, path, transform=transform, dtype=dtype)
+    return TensorCacheDataset(path)
+
+
+class TensorCacheDataset(Dataset):
+    '''
+    Dataset over a cache written by build_tensor_cache. Indexing with an int returns one sample, with a list of
+    indices (see cache_loader) a whole batch, read from the memory-mapped file by slicing.
+    '''
+    def __init__(self, path: str, dtype: torch.dtype=torch.float32):
+        self.images = np.load(os.path.join(path, 'images.npy'), mmap_mode='r')
+        self.labels = np.load(os.path.join(path, 'labels.npy'))
+        self.dtype = dtype
+        # Single channel images of the grayscale subsets are expanded back to their channels when read
+        self.channels = read_cache_metadata(path).get('channels')
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        if not np.isscalar(index):
+            index = np.asarray(index)
+            # Consecutive indices (sequential batches) are read as one slice
+            if len(index) > 0 and np.all(np.diff(index) == 1):
+                index = slice(int(index[0]), int(index[-1]) + 1)
+        images = torch.from_numpy(np.ascontiguousarray(self.images[index])).to(self.dtype)
+        if self.channels is not None:
+            images = images.expand(*images.shape[:-3], self.channels, *images.shape[-2:])
+        labels = self.labels[index]
+        return images, torch.as_tensor(labels)
+
+
+def cache_loader(dataset: TensorCacheDataset, batch_size: int, shuffle: bool=False, drop_last: bool=False, **kwargs):
+    '''
+    DataLoader which asks the cache dataset for whole batches (batch sampler, no per sample collate).
+    '''
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last), batch_size=None, **kwargs)
@@ -8,11 +8,19 @@ import matplotlib.pyplot as plt
 import torch.optim as optim
 from Pretrained_creation import  Simple_Net, Large_Simple_Net
 from CustomStatisticGrad.CustomStatisticGrad import CustomStatisticGrad
+from CustomStatisticGrad.grad_masks import MaskedOptimizer
+from CustomStatisticGrad.split_conv import split_convolutions
 import argparse
 from datasets.data_utils import cifar_part, kmnist_part, mnist_part, Fmnist_part
+from datasets.tensor_cache import open_tensor_cache, cache_loader
+from datasets.batch_transforms import use_batch_transforms
 import os
 def replicate_channels(im):
     return torch.stack([im, im, im]).squeeze()
+def cached_loader(dataset, name, args, batch_size):
+    # Rebuilt when the dataset transform, length or the cache dtype changed
+    path = os.path.join(args.tensor_cache, name)
+    return cache_loader(open_tensor_cache(dataset, path), batch_size=batch_size, shuffle=False)
 def main(args):
     torch.cuda.manual_seed_all(args.seed)
     batch_size = args.batch_size
@@ -21,6 +29,8 @@ def main(args):
     dataloader_pre2 = None
     if not os.path.exists(args.folder_save_stats):
         os.mkdir(args.folder_save_stats)
+    # Persistent loader workers keep the dataset transforms off the analysis / training loop
+    loader_kwargs = {'num_workers': args.loader_workers, 'persistent_workers': args.loader_workers > 0}
     ############# statistics for custom :
     if args.pre_dataset == 'CIFAR10':
         transform = transforms.Compose([transforms.Resize((64, 64)),
@@ -28,17 +38,17 @@ def main(args):
                                                                                     (0.5, 0.5, 0.5))])
         #dataset_pre = datasets.CIFAR10(root='.', train=True, download=True,transform=transform)
         dataset_pre = cifar_part(transform, train=True, middle_range=5, upper= True)
-        dataloader_pre = torch.utils.data.DataLoader(dataset_pre, batch_size=batch_size,shuffle=False)
+        dataloader_pre = torch.utils.data.DataLoader(dataset_pre, batch_size=batch_size,shuffle=False, **loader_kwargs)
 
     if args.pre_dataset == 'KMNIST':
         transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((64, 64)),
                                         transforms.Normalize((0.1307,), (0.3081,))])
         dataset_pre = kmnist_part(transform, train=True, middle_range=5, upper= True)
         dataloader_pre = torch.utils.data.DataLoader(dataset_pre, batch_size=batch_size,
-                                                     shuffle=False)
+                                                     shuffle=False, **loader_kwargs)
         dataset_pre2 = kmnist_part(transform, train=False, middle_range=5, upper= False, shuffle=True)
         dataloader_pre2 = torch.utils.data.DataLoader(dataset_pre2, batch_size=batch_size,
-                                                  shuffle=False)
+                                                  shuffle=False, **loader_kwargs)
 
 
     if args.pre_dataset == 'MNIST':
@@ -46,14 +56,14 @@ def main(args):
                                         transforms.Normalize((0.1307,), (0.3081,))])
         dataset_pre = mnist_part(transform, train=True, middle_range=5, upper= True)
         dataloader_pre = torch.utils.data.DataLoader(dataset_pre, batch_size=batch_size,
-                                                     shuffle=True)
+                                                     shuffle=True, **loader_kwargs)
 
     if args.pre_dataset == 'FMNIST':
         transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((64, 64)),
                                         transforms.Normalize((0.1307,), (0.3081,))])
         dataset_pre = Fmnist_part(transform, train=True, middle_range=5, upper= True)
         dataloader_pre = torch.utils.data.DataLoader(dataset_pre, batch_size=batch_size,
-                                                     shuffle=True)
+                                                     shuffle=True, **loader_kwargs)
 
     if args.test_dataset == 'CIFAR10':
         transform = transforms.Compose([transforms.Resize((64, 64)),
@@ -61,7 +71,7 @@ def main(args):
                                                                                     (0.5, 0.5, 0.5))])
         #dataset_new = datasets.CIFAR10(root='.', train=True, download=True,transform=transform)
         dataset_new = cifar_part(transform, train=True, middle_range=5, upper= False)
-        dataloader_new = torch.utils.data.DataLoader(dataset_new, batch_size=batch_size, shuffle=True)
+        dataloader_new = torch.utils.data.DataLoader(dataset_new, batch_size=batch_size, shuffle=True, **loader_kwargs)
 
         #testset = datasets.CIFAR10(root='./data', train=False,
         #                           download=True, transform=transform)
@@ -73,7 +83,7 @@ def main(args):
         dataset_train = dataset_new
 
         trainloader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size,
-                                                  shuffle=False)
+                                                  shuffle=False, **loader_kwargs)
 
     if args.test_dataset == 'FMNIST':
         transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((64, 64)),
@@ -83,14 +93,14 @@ def main(args):
         #
         dataset_new = Fmnist_part(transform, train=True, middle_range=5, upper=False)
         dataloader_new = torch.utils.data.DataLoader(dataset_new, batch_size=batch_size,
-                                                     shuffle=False)
+                                                     shuffle=False, **loader_kwargs)
         ## for training later
         testset = Fmnist_part(transform, train=False, middle_range=5, upper=False)
         testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
                                                  shuffle=False, num_workers=0)
         dataset_train = dataset_new
         trainloader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size,
-                                                  shuffle=False)
+                                                  shuffle=False, **loader_kwargs)
 
     if args.test_dataset == 'MNIST':
         transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((64, 64)),
@@ -100,14 +110,14 @@ def main(args):
         #
         dataset_new = mnist_part(transform, train=True, middle_range=5, upper=False)
         dataloader_new = torch.utils.data.DataLoader(dataset_new, batch_size=batch_size,
-                                                     shuffle=False)
+                                                     shuffle=False, **loader_kwargs)
         ## for training later
         testset = mnist_part(transform, train=False, middle_range=5, upper=False)
         testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
                                                  shuffle=False, num_workers=0)
         dataset_train = dataset_new
         trainloader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size,
-                                                  shuffle=False)
+                                                  shuffle=False, **loader_kwargs)
 
     if args.test_dataset == 'KMNIST':
         transform = transforms.Compose([transforms.ToTensor(), transforms.Resize((64, 64)),
@@ -117,14 +127,24 @@ def main(args):
         #
         dataset_new = kmnist_part(transform, train=True, middle_range=5, upper=False)
         dataloader_new = torch.utils.data.DataLoader(dataset_new, batch_size=batch_size,
-                                                     shuffle=False)
+                                                     shuffle=False, **loader_kwargs)
         ## for training later
         testset = kmnist_part(transform, train=False, middle_range=5, upper=False)
         testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
                                                  shuffle=False, num_workers=0)
         dataset_train = dataset_new
         trainloader = torch.utils.data.DataLoader(dataset_train, batch_size=batch_size,
-                                                  shuffle=False)
+                                                  shuffle=False, **loader_kwargs)
+
+    if args.tensor_cache is not None:
+        # The fine-tuning loaders read the transformed images from a memory-mapped cache built on the first run
+        trainloader = cached_loader(dataset_train, args.test_dataset + '_train', args, batch_size)
+        testloader = cached_loader(testset, args.test_dataset + '_test', args, testloader.batch_size)
+    if args.batch_transforms:
+        # Convert / resize / normalize whole uint8 batches in the collate instead of every sample in the dataset
+        dataloader_pre, dataloader_pre2, dataloader_new, trainloader, testloader = [
+            use_batch_transforms(loader) for loader in (dataloader_pre, dataloader_pre2, dataloader_new, trainloader,
+                                                        testloader)]
 
     if args.pre_model == 'simple':
         network = Simple_Net().to(args.device)
@@ -152,6 +172,21 @@ def main(args):
                                  save_folder=args.folder_save_stats + str(args.num_run),
                                  process_method=args.process_method, similarity=args.similarity_func, per_trained_dataset_2=dataloader_pre2)
         rg.run(mode=args.run_mode)
+        if args.hard_freeze:
+            if args.freezing_mode == 'freeze_except_bias':
+                # That mode trains the biases and raises the weight multiplier every epoch
+                raise ValueError('The hard freeze stops the gradients of the normal mode masks, got freezing_mode ' +
+                                 args.freezing_mode)
+            rg.hard_freeze(network)
+        if args.split_convs:
+            if args.freezing_mode == 'freeze_except_bias':
+                # The split convolutions are not scaled by the freeze_except_bias hooks
+                raise ValueError('The split convolutions freeze the normal mode masks, got freezing_mode ' +
+                                 args.freezing_mode)
+            # Partially frozen convolutions compute the weight gradients of their trainable kernels only
+            print('split convolutions: ' + str(split_convolutions(network, rg.layers_grad_mult)))
+        # The gradients of the first 55 epochs are scaled by hooks on the parameters during backward
+        grad_masks = rg.gradient_masks(network, mode=args.freezing_mode, until_epoch=55)
         #network.load_state_dict(torch.load(args.pre_model_path), strict=True)
 
         net = network
@@ -167,7 +202,15 @@ def main(args):
 
 
     criterion = torch.nn.CrossEntropyLoss()
-    optimizer = optim.Adam(net.parameters(), lr=args.lr)
+    if args.with_custom_grad and args.masked_optimizer:
+        if args.freezing_mode == 'freeze_except_bias':
+            raise ValueError('The masked optimizer applies the normal mode masks, got freezing_mode ' +
+                             args.freezing_mode)
+        # The optimizer steps the frozen kernels itself, the gradients are not scaled by the hooks
+        grad_masks.detach()
+        optimizer = MaskedOptimizer(net, rg.layers_grad_mult, rg.modules_name_list, optim.Adam, lr=args.lr)
+    else:
+        optimizer = optim.Adam(net.parameters(), lr=args.lr)
     #optimizer = optim.RMSprop(net.parameters(), lr=args.lr)
 
     # cycle_opt = torch.optim.lr_scheduler.CyclicLR(optimizer, args.lr/10, args.lr * 10,
@@ -190,6 +233,8 @@ def main(args):
     accuracy_list = []
     for epoch in range(args.num_epochs):  # loop over the dataset multiple times
         running_loss = 0.0
+        if args.with_custom_grad:
+            grad_masks.set_epoch(epoch)
         for i, data in enumerate(trainloader, args.seed):
             if i-args.seed >= amount_data / batch_size:
                 break
@@ -200,9 +245,6 @@ def main(args):
             outputs = net(inputs.cuda())
             loss = criterion(outputs, labels.cuda())
             loss.backward()
-            if args.with_custom_grad:
-                if epoch < 55:
-                    rg.update_grads(net=net, epoch=epoch, mode=args.freezing_mode)
             optimizer.step()
             if args.cycle_opt:
                 cycle_opt.step()
@@ -278,11 +320,21 @@ if __name__ == '__main__':
     parser.add_argument('--deepest_layer', type=int, default=22)
     parser.add_argument('--run_mode', type=str, default='normal')
     parser.add_argument('--freezing_mode', type=str, default='normal')
+    parser.add_argument('--hard_freeze', action='store_true',
+                        help='layers with near zero masks (per_layer mode) get no gradients at all')
+    parser.add_argument('--split_convs', action='store_true',
+                        help='split partially frozen convolutions into frozen and trainable sub-convolutions')
+    parser.add_argument('--masked_optimizer', action='store_true',
+                        help='keep optimizer state only for the trainable kernels, SGD steps for the frozen ones')
     parser.add_argument('--similarity_func', type=str, default='ws')
 
     # Training
     parser.add_argument('--device', type=str, default='cuda')
     parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--loader_workers', type=int, default=0)
+    parser.add_argument('--batch_transforms', action='store_true',
+                        help='apply the dataset transforms to whole batches in the loader collate')
+    parser.add_argument('--tensor_cache', type=str, default=None, help='folder of the pre-transformed dataset caches')
     parser.add_argument('--num_batch', type=int, default=3)
     parser.add_argument('--num_epochs', type=int, default=55)
     parser.add_argument('--lr', type=float, default=8E-4)